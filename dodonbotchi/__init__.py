@@ -1,4 +1,17 @@
 from . import config
 from . import mame
 from . import util
+from . import cache
 from . import exy
+from . import traces
+from . import wire
+from . import sink
+from . import ipc
+from . import remote
+from . import fakemame
+from . import bench
+from . import metrics
+from . import fixed
+from . import observation
+from . import danger
+from . import islands
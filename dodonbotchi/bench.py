@@ -0,0 +1,208 @@
+"""
+This module implements a benchmark suite measuring DoDonBotchi's throughput
+against the fake MAME from `dodonbotchi.fakemame`, so changes to the IPC or
+the GA can be measured on machines without MAME or the ROM. Timings include
+the fake's own cost of producing game states, which is deterministic for a
+given object count.
+"""
+import json
+import logging as log
+import random
+import time
+
+from pathlib import Path
+
+import numpy as np
+
+from dodonbotchi import ipc
+from dodonbotchi.config import CFG as cfg
+from dodonbotchi.exy import Exy
+from dodonbotchi.mame import Ddonpach, DdonpachSyncError, get_action_str
+from dodonbotchi.util import ensure_directories
+
+BENCH_STEPS = 2000
+BENCH_EVALUATIONS = 32
+BENCH_OBJECTS = 16
+BENCH_WINDOW = 121
+CHECK_WAIT_FRAMES = 480  # Like the wait at the start of the first level
+
+
+def use_fake_mame(objects=BENCH_OBJECTS, wire_format=None):
+    """
+    Switches the global configuration over to the fake MAME with the given
+    amount of objects per class.
+    """
+    cfg.fake_mame = True
+    cfg.fake_objects = objects
+    cfg.port = 0
+    if wire_format:
+        cfg.wire_format = wire_format
+
+
+def random_actions(rng, count):
+    actions = []
+    for _ in range(count):
+        vert, hori = rng.randint(0, 2), rng.randint(0, 2)
+        actions.append(get_action_str(vert=vert, hori=hori, shot=1))
+    return actions
+
+
+def open_session(cwd, name):
+    ins = cwd / 'ins' / name
+    ddonpach = Ddonpach(port=0, plugins_dir=str(ins / 'plg'))
+    ddonpach.inp_dir = str(ins / 'inp')
+    ddonpach.snp_dir = str(ins / 'snp')
+    return ddonpach
+
+
+def percentiles(latencies):
+    millis = np.array(latencies) * 1000
+    return {
+        'p50_ms': float(np.percentile(millis, 50)),
+        'p90_ms': float(np.percentile(millis, 90)),
+        'p99_ms': float(np.percentile(millis, 99)),
+    }
+
+
+def check_wait(cwd, frames=CHECK_WAIT_FRAMES):
+    """
+    Checks that waiting for the given amount of frames right after loading a
+    savestate emulates at least that many frames, which replays from the
+    start of the first level rely on. Returns the frames that passed and
+    raises a `DdonpachSyncError` if there were too few.
+    """
+    start_state = str((cwd / 'check-start.sta').resolve())
+
+    with open_session(cwd, 'check') as ddonpach:
+        ddonpach.send_action(get_action_str())
+        before = ddonpach.read_gamestate()['frame']
+        ddonpach.send_save_state(start_state)
+        ddonpach.send_load_state(start_state)
+        after = ddonpach.send_wait_until('frames', frames)['frame']
+
+    if after - before < frames:
+        raise DdonpachSyncError('Waited {} frames after a load, expected {}.'
+                                .format(after - before, frames))
+    return after - before
+
+
+def bench_steps(cwd, steps=BENCH_STEPS, seed=0):
+    """
+    Plays the given amount of random actions one command at a time, timing
+    every round trip. Deaths and the score screen restart from a savestate
+    taken at the start.
+    """
+    rng = random.Random(seed)
+    start_state = str((cwd / 'bench-start.sta').resolve())
+
+    with open_session(cwd, 'steps') as ddonpach:
+        ddonpach.send_save_state(start_state)
+        received = ddonpach.stream.received
+
+        latencies = []
+        begin = time.perf_counter()
+        for action in random_actions(rng, steps):
+            sent = time.perf_counter()
+            ddonpach.send_action(action)
+            state = ddonpach.read_gamestate()
+            latencies.append(time.perf_counter() - sent)
+
+            if state['death'] or state['scoreScreen']:
+                ddonpach.send_load_state(start_state)
+        elapsed = time.perf_counter() - begin
+        received = ddonpach.stream.received - received
+
+    result = {
+        'steps_per_sec': steps / elapsed,
+        'bytes_per_step': received / steps,
+    }
+    result.update(percentiles(latencies))
+    return result
+
+
+def bench_rollout(cwd, steps=BENCH_STEPS, window=BENCH_WINDOW, seed=0):
+    """
+    Plays the given amount of random actions as rollouts of `window` actions
+    each, restarting from a savestate after every rollout like evaluations do.
+    """
+    rng = random.Random(seed)
+    start_state = str((cwd / 'bench-start.sta').resolve())
+
+    with open_session(cwd, 'rollout') as ddonpach:
+        ddonpach.send_save_state(start_state)
+        received = ddonpach.stream.received
+
+        played = 0
+        latencies = []
+        begin = time.perf_counter()
+        while played < steps:
+            actions = random_actions(rng, min(window, steps - played))
+            sent = time.perf_counter()
+            trace, _ = ddonpach.send_rollout(actions)
+            latencies.append(time.perf_counter() - sent)
+            ddonpach.send_load_state(start_state)
+            played += len(actions)
+        elapsed = time.perf_counter() - begin
+        received = ddonpach.stream.received - received
+
+    result = {
+        'steps_per_sec': played / elapsed,
+        'bytes_per_step': received / played,
+    }
+    result.update(percentiles(latencies))
+    return result
+
+
+def bench_evaluate(cwd, evaluations=BENCH_EVALUATIONS):
+    """
+    Evaluates a population of the given size with `Exy.evaluate` on the
+    configured amount of instances.
+    """
+    exy = Exy(str(cwd / 'exy'), headless=True)
+    try:
+        pop = exy.toolbox.population(n=evaluations)
+        begin = time.perf_counter()
+        exy.evaluate_population(pop)
+        elapsed = time.perf_counter() - begin
+    finally:
+        exy.close()
+
+    return {'evaluations_per_min': evaluations / elapsed * 60}
+
+
+def run(cwd, steps=BENCH_STEPS, evaluations=BENCH_EVALUATIONS,
+        objects=BENCH_OBJECTS):
+    """
+    Runs every benchmark against the fake MAME in the given working directory
+    for each wire format, along with `check_wait` and the comparison of
+    message framing from `dodonbotchi.ipc.benchmark`, logs the results and
+    writes them to `bench.json`.
+    """
+    cwd = Path(cwd)
+    ensure_directories(str(cwd))
+
+    results = {'objects': objects, 'framing': ipc.benchmark()}
+    for wire_format in ('json', 'binary'):
+        use_fake_mame(objects=objects, wire_format=wire_format)
+        results[wire_format] = {
+            'wait_after_load': {'frames': check_wait(cwd)},
+            'steps': bench_steps(cwd, steps=steps),
+            'rollout': bench_rollout(cwd, steps=steps),
+            'evaluate': bench_evaluate(cwd, evaluations=evaluations),
+        }
+
+    for wire_format in ('json', 'binary'):
+        for name, result in results[wire_format].items():
+            fields = ', '.join('{}={:.2f}'.format(key, val)
+                               for key, val in sorted(result.items()))
+            log.info('%s %s: %s', wire_format, name, fields)
+
+    for reader, rate in sorted(results['framing'].items()):
+        log.info('framing %s: messages_per_sec=%.2f', reader, rate)
+
+    out_file = cwd / 'bench.json'
+    with open(out_file, 'w') as out:
+        json.dump(results, out, indent=4, sort_keys=True)
+    log.info('Wrote benchmark results to: %s', out_file)
+
+    return results
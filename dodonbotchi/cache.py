@@ -0,0 +1,215 @@
+"""
+This module implements a cache of evaluated action sequences for the GA. Since
+the emulator is deterministic from a savestate, candidates sharing a prefix of
+actions also share the outcome of every step in that prefix. The cache is a
+trie keyed on actions whose nodes store the step outcome reached by the prefix
+leading to them and, within a budget, a savestate taken right after it. Those
+savestates are evicted in least-recently-used order.
+
+The cache only holds sequences starting from the same machine state, so it has
+to be cleared whenever the window being evolved changes.
+"""
+import logging as log
+import os
+import threading
+
+from collections import OrderedDict
+
+
+class PrefixNode:
+    """
+    Node of the prefix trie. `step` is the (score, combo, death, score screen,
+    danger) tuple observed after the action leading to this node and `state`
+    the path of a savestate taken right after that action, if any.
+    """
+    __slots__ = ('children', 'step', 'state')
+
+    def __init__(self):
+        self.children = {}
+        self.step = None
+        self.state = None
+
+
+class PrefixCache:
+    """
+    Thread-safe trie of step outcomes and savestates keyed on action prefixes.
+    Savestates are stored in the given directory, keeping at most `max_states`
+    of them around.
+    """
+
+    def __init__(self, state_dir, max_states=64):
+        self.state_dir = state_dir
+        self.max_states = max_states
+
+        self.lock = threading.Lock()
+        self.root = PrefixNode()
+        self.states = OrderedDict()
+        self.state_count = 0
+
+        self.starting_score = None
+
+        self.hits = 0
+        self.steps_saved = 0
+
+        self.max_gain = 0
+        self.pruned = 0
+        self.steps_pruned = 0
+
+    def clear(self):
+        """
+        Empties the cache and deletes every savestate it holds.
+        """
+        with self.lock:
+            for node in self.states:
+                self.delete_state(node)
+
+            self.root = PrefixNode()
+            self.states = OrderedDict()
+            self.starting_score = None
+
+            self.hits = 0
+            self.steps_saved = 0
+
+            self.max_gain = 0
+            self.pruned = 0
+            self.steps_pruned = 0
+
+    def delete_state(self, node):
+        if os.path.exists(node.state):
+            os.remove(node.state)
+        node.state = None
+
+    def walk(self, actions):
+        """
+        Yields the nodes along the known part of the given action sequence.
+        """
+        node = self.root
+        for action in actions:
+            node = node.children.get(action)
+            if not node:
+                return
+            yield node
+
+    def complete_trace(self, actions):
+        """
+        Returns the list of step outcomes of the given action sequence if they
+        are all known, either because the whole sequence is cached or because
+        a cached prefix of it ends in a death or the score screen. Returns
+        None otherwise.
+        """
+        with self.lock:
+            trace = []
+            death = score_screen = False
+            for node in self.walk(actions):
+                trace.append(node.step)
+                death, score_screen = node.step[2:4]
+                if death or score_screen:
+                    break
+
+            if len(trace) < len(actions) and not (death or score_screen):
+                return None
+
+            self.hits += 1
+            self.steps_saved += len(trace)
+            return trace
+
+    def resume_point(self, actions):
+        """
+        Finds the deepest cached savestate along the given action sequence and
+        returns the step outcomes up to it, the amount of actions they cover
+        and the path of the savestate. The savestate path is None and the
+        trace empty if the sequence has to be played from the start.
+        """
+        with self.lock:
+            trace = []
+            resume = None
+            depth = 0
+            for node in self.walk(actions):
+                trace.append(node.step)
+                if node.state:
+                    resume = node
+                    depth = len(trace)
+
+            if not resume:
+                return [], 0, None
+
+            self.states.move_to_end(resume)
+            self.steps_saved += depth
+            return trace[:depth], depth, resume.state
+
+    def next_state_path(self):
+        """
+        Returns the path a new savestate for this cache should be written to,
+        or None if the cache does not keep savestates.
+        """
+        if not self.max_states:
+            return None
+
+        with self.lock:
+            self.state_count += 1
+            name = '{:08}.sta'.format(self.state_count)
+            return os.path.abspath(os.path.join(self.state_dir, name))
+
+    def insert(self, actions, trace, state=None):
+        """
+        Records the given step outcomes of the given action sequence, along
+        with a savestate taken after its last action if given. Also keeps
+        track of the largest score gained in a single step, which needs the
+        starting score to be set.
+        """
+        with self.lock:
+            previous = self.starting_score
+            for step in trace:
+                if previous is not None:
+                    self.max_gain = max(self.max_gain, step[0] - previous)
+                previous = step[0]
+
+            node = self.root
+            for action, step in zip(actions, trace):
+                child = node.children.get(action)
+                if not child:
+                    child = PrefixNode()
+                    node.children[action] = child
+                child.step = step
+                node = child
+
+            if not state:
+                return
+
+            if node.state and node.state != state:
+                self.delete_state(node)
+                del self.states[node]
+
+            node.state = state
+            self.states[node] = state
+            self.states.move_to_end(node)
+
+            while len(self.states) > self.max_states:
+                evicted, _ = self.states.popitem(last=False)
+                self.delete_state(evicted)
+
+    def count_pruned(self, steps):
+        """
+        Counts a candidate whose evaluation was cut short, skipping the given
+        amount of steps.
+        """
+        with self.lock:
+            self.pruned += 1
+            self.steps_pruned += steps
+
+    def log_stats(self):
+        """
+        Logs the hits and steps saved since the cache was cleared, and the
+        pruned candidates since the previous call, which is once per
+        generation.
+        """
+        log.info('Prefix cache: %s full hits, %s emulator steps saved.',
+                 self.hits, self.steps_saved)
+
+        with self.lock:
+            pruned, steps = self.pruned, self.steps_pruned
+            self.pruned = 0
+            self.steps_pruned = 0
+        if pruned:
+            log.info('Pruned %s candidates, %s emulator steps saved.',
+                     pruned, steps)
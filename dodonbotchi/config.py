@@ -26,6 +26,30 @@ RENDER_SPRITES = "false"
 RENDER_STATE = "false"
 SHOW_INPUT = "true"
 TICK_RATE = 2
+INSTANCES = 1
+FRAME_SAMPLE = 1
+WIRE_FORMAT = 'binary'
+DELTA_STATES = False
+KEYFRAME_INTERVAL = 60
+CACHE_STRIDE = 30
+CACHE_STATES = 64
+FRAME_WORKERS = 2
+FRAME_BACKLOG = 16
+FRAME_SINK = 'png'
+FFMPEG_PATH = 'ffmpeg'
+VIDEO_CODEC = 'libx264'
+VIDEO_FPS = 30
+SEGMENT_FRAMES = 9000
+WORKERS = []
+FAKE_MAME = False
+FAKE_OBJECTS = 16
+METRICS = False
+DANGER_WEIGHT = 0
+APPROX_PRUNE = False
+ISLANDS = 1
+MIGRATION_INTERVAL = 4
+MIGRANTS = 1
+MAX_HOLD = 1
 
 
 class Config(dict):
@@ -94,6 +118,30 @@ def get_default():
         'render_state': RENDER_STATE,
         'show_input': SHOW_INPUT,
         'tick_rate': TICK_RATE,
+        'instances': INSTANCES,
+        'frame_sample': FRAME_SAMPLE,
+        'wire_format': WIRE_FORMAT,
+        'delta_states': DELTA_STATES,
+        'keyframe_interval': KEYFRAME_INTERVAL,
+        'cache_stride': CACHE_STRIDE,
+        'cache_states': CACHE_STATES,
+        'frame_workers': FRAME_WORKERS,
+        'frame_backlog': FRAME_BACKLOG,
+        'frame_sink': FRAME_SINK,
+        'ffmpeg_path': FFMPEG_PATH,
+        'video_codec': VIDEO_CODEC,
+        'video_fps': VIDEO_FPS,
+        'segment_frames': SEGMENT_FRAMES,
+        'workers': WORKERS,
+        'fake_mame': FAKE_MAME,
+        'fake_objects': FAKE_OBJECTS,
+        'metrics': METRICS,
+        'danger_weight': DANGER_WEIGHT,
+        'approx_prune': APPROX_PRUNE,
+        'islands': ISLANDS,
+        'migration_interval': MIGRATION_INTERVAL,
+        'migrants': MIGRANTS,
+        'max_hold': MAX_HOLD,
     }
 
     default = Config()
@@ -105,11 +153,13 @@ def ensure_config(cfg_file):
     """
     Tests if the given cfg_file path points to a configuration file. If not, a
     default configuration will be written to that file. The file is then loaded
-    into the `CFG` field.
+    into the `CFG` field on top of the default values, so options missing from
+    older configuration files keep their defaults.
     """
     if not os.path.exists(cfg_file):
         default = get_default()
         default.save(cfg_file)
         log.debug('Saved fresh default cfg to: %s', cfg_file)
 
+    CFG.load_values(get_default())
     CFG.load(cfg_file)
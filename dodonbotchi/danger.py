@@ -0,0 +1,152 @@
+"""
+This module implements a measure of how much danger the ship is in, used to
+shape fitness beyond score and combo. Each step, the bullets and enemies of a
+game state are bucketed into a uniform grid over the playfield in one NumPy
+pass and only the ones in cells around the ship are looked at closely. Nearby
+objects are dangerous for being close and for heading towards the ship,
+the latter judged by when they would pass it closest given their movement
+since the previous step.
+
+Danger is a value between 0 and 1 per step, reaching 1 once an object touches
+the ship or is about to.
+"""
+import numpy as np
+
+from dodonbotchi.observation import object_columns
+
+DANGER_CLASSES = ('bullets', 'enemies')
+DANGER_CELL = 16  # Pixels per side of a grid cell
+DANGER_RADIUS = 64  # Pixels around the ship that are inspected
+DANGER_HORIZON = 8  # Steps ahead a collision still counts as danger
+HIT_RADIUS = 4  # Pixels of the ship that actually collide
+
+
+def object_slots(objects):
+    if isinstance(objects, np.ndarray):
+        return objects['slot'].astype(np.int64)
+    return np.array([obj['slot'] for obj in objects], dtype=np.int64)
+
+
+class DangerIndex:
+    """
+    Measures the danger of consecutive game states of one evaluation. Object
+    movement is tracked across states by memory slot, so the index has to be
+    reset before states of an unrelated sequence are measured.
+    """
+
+    def __init__(self, cell=DANGER_CELL, radius=DANGER_RADIUS,
+                 horizon=DANGER_HORIZON):
+        self.cell = cell
+        self.radius = radius
+        self.horizon = horizon
+        # Grid cells around the ship's own that are within the radius
+        self.reach = -(-radius // cell)
+
+        self.reset()
+
+    def reset(self):
+        self.previous = None
+        self.previous_ship = None
+        self.values = []
+
+    def observe(self, state):
+        """
+        Measures the given game state and keeps the result for `take`. Meant
+        as the `observe` callback of `Ddonpach.send_rollout`.
+        """
+        self.values.append(self.measure(state))
+
+    def take(self):
+        """
+        Returns the dangers observed since the last call, in order.
+        """
+        values, self.values = self.values, []
+        return values
+
+    def collect(self, state):
+        """
+        Returns the slots, centers and half sizes of every object of the
+        dangerous classes in the given state.
+        """
+        slots, centers, halves = [], [], []
+        for idx, name in enumerate(DANGER_CLASSES):
+            columns = object_columns(state[name])
+            # Slots are only unique within a class.
+            slots.append(object_slots(state[name]) * len(DANGER_CLASSES) + idx)
+            halves.append(columns[:, 2:] / 2)
+            centers.append(columns[:, :2] + halves[-1])
+
+        return (np.concatenate(slots), np.concatenate(centers),
+                np.concatenate(halves))
+
+    def velocities(self, slots, centers):
+        """
+        Returns the movement of each object since the previous state, zero
+        for objects that were not around then.
+        """
+        moved = np.zeros_like(centers)
+        if self.previous is None:
+            return moved
+
+        prev_slots, prev_centers = self.previous
+        _, now, before = np.intersect1d(slots, prev_slots,
+                                        assume_unique=True,
+                                        return_indices=True)
+        moved[now] = centers[now] - prev_centers[before]
+        return moved
+
+    def nearby(self, centers, ship):
+        """
+        Buckets the given centers into the grid and returns the indices of the
+        ones in cells around the given ship position.
+        """
+        cell_x = centers[:, 0] // self.cell
+        cell_y = centers[:, 1] // self.cell
+        near = ((np.abs(cell_x - ship[0] // self.cell) <= self.reach) &
+                (np.abs(cell_y - ship[1] // self.cell) <= self.reach))
+        return np.flatnonzero(near)
+
+    def measure(self, state):
+        """
+        Returns the danger the ship is in in the given game state, which has to
+        follow the previously measured one. Movement is taken relative to the
+        ship's own.
+        """
+        slots, centers, halves = self.collect(state)
+        moved = self.velocities(slots, centers)
+        self.previous = (slots, centers)
+
+        if not len(state['ship']):
+            return 0.0
+        ship = object_columns(state['ship'][:1])[0]
+        ship = ship[:2] + ship[2:] / 2
+        ship_moved = np.zeros(2, np.float32)
+        if self.previous_ship is not None:
+            ship_moved = ship - self.previous_ship
+        self.previous_ship = ship
+
+        near = self.nearby(centers, ship)
+        if not len(near):
+            return 0.0
+
+        offset = centers[near] - ship
+        velocity = moved[near] - ship_moved
+        reach = HIT_RADIUS + halves[near].max(axis=1)
+
+        distance = np.hypot(offset[:, 0], offset[:, 1])
+        proximity = 1 - np.clip((distance - reach) / self.radius, 0, 1)
+
+        # Time and distance of the closest approach along current movement
+        speed = (velocity ** 2).sum(axis=1)
+        closing = -(offset * velocity).sum(axis=1)
+        moving = speed > 0
+        when = np.zeros_like(distance)
+        when[moving] = closing[moving] / speed[moving]
+        when = np.clip(when, 0, None)
+        closest = offset + velocity * when[:, None]
+        miss = np.hypot(closest[:, 0], closest[:, 1])
+
+        impact = (miss <= reach) & (when <= self.horizon)
+        urgency = np.where(impact, 1 - when / self.horizon, 0)
+
+        return float(max(proximity.max(), urgency.max()))
@@ -3,10 +3,11 @@ import json
 import logging as log
 import math
 import os
-import queue
+import pickle
 import random
 import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from time import sleep
 
@@ -21,9 +22,18 @@ from deap import base
 from deap import creator
 from deap import tools
 
+from .cache import PrefixCache
 from .config import CFG as cfg
-from .mame import Ddonpach, get_action_str
-from .util import ensure_directories, get_now_string
+from .danger import DangerIndex
+from .fixed import FixedLog, convert_directory, convert_text
+from .islands import Islands
+from .mame import Ddonpach, DdonpachPool, DdonpachSyncError
+from .mame import get_action_str, replay_fixed, split_action
+from .remote import Coordinator
+from .sink import PngSink, VideoSink
+from .metrics import METRICS as metrics
+from .traces import TraceRecorder
+from .util import ensure_directories
 
 sns.set()
 
@@ -38,7 +48,11 @@ for vert in range(3):
 assert len(DIRECTIONS) == 8
 
 WINDOW_SIZE = 121
+PRUNE_MARGIN = 2  # Multiple of the largest observed step gain assumed ahead
+PRUNED_FITNESS = (-100, -100, False)  # No better than dying on the first step
+SCORE_STEP = 5000  # Score increase per point of the score component
 CXPB, MUTPB = 0.5, 0.2
+HOLD_MUTPB = 0.5  # Chance of a mutation changing only a hold duration
 POP = 10
 GENS = 16
 
@@ -46,17 +60,6 @@ FONT_SIZE = 10
 WATERMARK = '@Signaltonsalat'
 WATERMARK_SIZE = 8
 
-save_queue = queue.Queue()
-finished = False
-
-
-def saver():
-    global save_queue
-    while save_queue.full() or not finished:
-        img, path = save_queue.get()
-        img.save(path)
-        save_queue.task_done()
-
 
 def clear_labels_ticks(*plots):
     for plot in plots:
@@ -124,23 +127,40 @@ def get_best_individual(pop):
     return sortpop[-1]
 
 
-class DdonpachSyncError(Exception):
-    pass
-
-
 class Exy:
     size = WINDOW_SIZE
 
-    def __init__(self, cwd):
+    def __init__(self, cwd, headless=False, island=None):
         self.rng = random.Random()
+        self.headless = headless
+        self.island = island
 
         cwd = Path(cwd)
+        self.cwd = cwd
         self.inp = cwd / 'inp'
         self.fxd = cwd / 'fxd'
         self.rnd = cwd / 'rnd'
         self.snp = cwd / 'snp'
         self.sav = cwd / 'sav'
-        dirs = [self.inp, self.rnd, self.snp, self.sav, self.fxd]
+        self.evo = cwd / 'evo.pkl'
+
+        # Islands share the fixed steps and checkpoints of the run, but keep
+        # their emulator instances, caches and records apart.
+        own = cwd
+        self.cache = self.sav / 'cache'
+        self.port_offset = 0
+        if island is not None:
+            own = cwd / 'isl' / '{:02}'.format(island)
+            self.cache = own / 'cache'
+            self.port_offset = (island + 1) * cfg.instances
+        self.ins = own / 'ins'
+        self.trc = own / 'trc'
+        self.mtr = own / 'mtr'
+
+        dirs = [self.inp, self.rnd, self.snp, self.sav, self.fxd, self.ins,
+                self.cache]
+        if cfg.metrics:
+            dirs.append(self.mtr)
         ensure_directories(*[str(p) for p in dirs])
 
         self.fitness = None
@@ -159,39 +179,80 @@ class Exy:
 
         self.current_deaths = 0
         self.current_success = 0
+        self.stats_lock = threading.Lock()
 
         self.level = 0
         self.current_sav = None
         self.current_fxd = None
 
         self.fixed_steps = 0
+        self.generation = 0
+        self.resumed = None
+        self.prune_bound = None
+
+        metrics.enable(cfg.metrics)
+        self.traces = TraceRecorder(str(self.trc))
+        self.prefix_cache = PrefixCache(str(self.cache),
+                                        max_states=cfg.cache_states)
+        self.islands = None
+
+        # With remote workers configured, evaluations go to them and the
+        # local pool only takes care of checkpoints and level transitions.
+        self.remote = None
+        slots = cfg.instances
+        if cfg.workers:
+            self.remote = Coordinator(cfg.workers)
+            slots = self.remote.slots
+
+        self.pool = DdonpachPool(self.open_instance, size=cfg.instances)
+        self.scheduler = ThreadPoolExecutor(max_workers=slots)
 
         self.frame = 1
-        self.saved = 1
+        self.frames = None
 
         self.inc_level(ensure=True)
-        self.reset_plots()
+        if not self.headless:
+            self.frames = self.open_frame_sink()
+            self.reset_plots()
         self.setup_deap()
 
+    def open_frame_sink(self):
+        if cfg.frame_sink == 'video':
+            return VideoSink(str(self.rnd),
+                             segment_frames=cfg.segment_frames,
+                             fps=cfg.video_fps, codec=cfg.video_codec,
+                             ffmpeg=cfg.ffmpeg_path,
+                             backlog=cfg.frame_backlog)
+
+        return PngSink(str(self.rnd), workers=cfg.frame_workers,
+                       backlog=cfg.frame_backlog)
+
     def inc_level(self, ensure=False):
         self.level += 1
         self.current_sav = '{:03}'.format(self.level)
-        self.current_fxd = self.fxd / '{:03}.txt'.format(self.level)
+        self.current_fxd = self.fxd / '{:03}.fxd'.format(self.level)
 
-        if ensure and not self.current_fxd.exists():
-            with open(self.current_fxd, 'w') as fixed:
-                pass
+        if not self.current_fxd.exists():
+            legacy = self.current_fxd.with_suffix('.txt')
+            if legacy.exists():
+                log.info('Converting fixed steps of level %s from: %s',
+                         self.level, legacy)
+                convert_text(legacy, self.current_fxd)
+            elif ensure:
+                FixedLog(self.current_fxd)
 
     def advance_level(self):
-        with self.open_ddonpach() as ddonpach:
-            _, finished = self.replay_level(ddonpach)
+        self.count_fixed_steps()
+        start = self.find_checkpoint(self.fixed_steps)
+        with self.pool.session() as ddonpach:
+            ddonpach.send_load_state(self.checkpoint_path(start))
+            _, finished = self.replay_level(ddonpach, start=start)
             assert finished
-            ddonpach.send_command(command='wait', frames=380)
-            ddonpach.read_gamestate()
+            ddonpach.send_wait_until('frames', 380)
 
             self.inc_level(ensure=True)
 
-            ddonpach.send_save_state(self.current_sav)
+            ddonpach.send_save_state(self.state_path(self.current_sav))
 
 
 
@@ -265,56 +326,136 @@ class Exy:
         self.toolbox.register('mutate', self.mutate)
         self.toolbox.register('select', tools.selTournament, tournsize=3)
 
-    def open_ddonpach(self, recording=None):
-        ddonpach = Ddonpach(recording, state=self.current_sav)
+    def open_ddonpach(self, recording=None, state=None):
+        if not state:
+            state = self.current_sav
+        ddonpach = Ddonpach(recording, state=state)
         ddonpach.inp_dir = str(self.inp)
         ddonpach.snp_dir = str(self.snp)
         ddonpach.sav_dir = str(self.sav)
         return ddonpach
 
+    def open_instance(self, idx):
+        """
+        Creates the `Ddonpach` session of the pooled emulator instance with the
+        given index. Each instance gets its own port, plugin render and
+        inp/snp/sav directories, so several of them can run side by side.
+        Shared savestates are addressed by absolute paths.
+        """
+        ins = self.ins / '{:03}'.format(idx)
+        port = cfg.port + self.port_offset + idx if cfg.port else 0
+        state = self.state_path(self.current_sav)
+        ddonpach = Ddonpach(state=state, port=port,
+                            plugins_dir=str(ins / 'plg'))
+        ddonpach.inp_dir = str(ins / 'inp')
+        ddonpach.snp_dir = str(ins / 'snp')
+        ddonpach.sav_dir = str(ins / 'sav')
+        return ddonpach
+
+    def close(self):
+        if self.islands:
+            self.islands.close()
+        self.scheduler.shutdown()
+        self.pool.close()
+        if self.remote:
+            self.remote.close()
+        self.traces.close()
+        if self.frames:
+            self.frames.close()
+
     def count_fixed_steps(self):
-        self.fixed_steps = 0
-        with open(self.current_fxd, 'r') as fixed:
-            for action in fixed:
-                self.fixed_steps += 1
-
-    def replay_level(self, ddonpach):
-        if self.level == 1:
-            # Quirk because the load screen detection works by
-            # checking for the score results screen, but when
-            # starting the first level, there is no results
-            # screen, of course. Instead we wait a fixed time.
-            ddonpach.send_command(command='wait', frames=480)
-            ddonpach.read_gamestate()
-        else:
-            # Otherwise, it's assumed the game loaded inside a
-            # score screen that we wait to end.
-            ddonpach.send_action(get_action_str(vert=0, hori=0, shot=0))
-            state = ddonpach.read_gamestate()
-            ddonpach.send_command(command='waitScore')
-            state = ddonpach.read_gamestate()
-            # state = ddonpach.read_gamestate()
-            # assert state['scoreScreen']
-            # while state['scoreScreen']:
-
-        score = 0
-        with open(self.current_fxd, 'r') as fixed:
-            for line in fixed:
-                action, score = line.split(';')
-                ddonpach.send_action(action)
-                state = ddonpach.read_gamestate()
-                if int(score) != state['score']:
-                    raise DdonpachSyncError('Score out of sync during replay.')
-
-                if state['scoreScreen']:
-                    return int(score), True
-
-        return int(score), False
+        self.fixed_steps = len(FixedLog(self.current_fxd))
+
+    def checkpoint_name(self, steps):
+        """
+        Returns the name of the savestate taken after the given amount of fixed
+        steps into the current level. Zero steps is the level's own savestate.
+        """
+        if not steps:
+            return self.current_sav
+        return '{}-{:06}'.format(self.current_sav, steps)
+
+    def state_path(self, name):
+        """
+        Returns the absolute path of the shared savestate with the given name.
+        MAME uses absolute paths as-is instead of resolving them relative to
+        an instance's state directory.
+        """
+        path = self.sav / 'ddonpach' / '{}.sta'.format(name)
+        return str(path.resolve())
+
+    def checkpoint_path(self, steps):
+        return self.state_path(self.checkpoint_name(steps))
+
+    def get_checkpoints(self):
+        """
+        Returns a sorted list of fixed step counts of the current level that
+        have a checkpoint savestate on disk.
+        """
+        checkpoints = []
+        pattern = '{}-*.sta'.format(self.current_sav)
+        for path in (self.sav / 'ddonpach').glob(pattern):
+            steps = path.stem.split('-')[-1]
+            if steps.isdigit():
+                checkpoints.append(int(steps))
+        return sorted(checkpoints)
+
+    def find_checkpoint(self, steps):
+        """
+        Returns the largest checkpointed step count that does not exceed the
+        given amount of steps, or 0 if only the level savestate is usable.
+        """
+        checkpoints = [c for c in self.get_checkpoints() if c <= steps]
+        if checkpoints:
+            return checkpoints[-1]
+        return 0
+
+    def save_checkpoint(self):
+        """
+        Replays the fixed steps from the newest checkpoint and saves the
+        resulting machine state as a new checkpoint, so later evaluations do
+        not have to replay the whole fixed prefix again.
+        """
+        self.count_fixed_steps()
+        start = self.find_checkpoint(self.fixed_steps)
+        if start == self.fixed_steps:
+            return
+
+        with self.pool.session() as ddonpach:
+            ddonpach.send_load_state(self.checkpoint_path(start))
+            self.replay_level(ddonpach, start=start)
+            ddonpach.send_save_state(self.checkpoint_path(self.fixed_steps))
+
+        log.info('Saved checkpoint after %s fixed steps.', self.fixed_steps)
+
+    def drop_checkpoints(self, steps):
+        """
+        Deletes every checkpoint of the current level taken after more than the
+        given amount of fixed steps.
+        """
+        for checkpoint in self.get_checkpoints():
+            if checkpoint > steps:
+                os.remove(self.checkpoint_path(checkpoint))
+
+    def read_fixed(self):
+        """
+        Returns the list of (action, score) pairs fixed so far in the current
+        level.
+        """
+        return FixedLog(self.current_fxd).steps()
+
+    def replay_level(self, ddonpach, start=0):
+        with metrics.timer('exy.replay'):
+            fixed = self.read_fixed()
+            return replay_fixed(ddonpach, self.level, fixed, start)
 
     def sample_action(self, count=1):
         vert, hori = self.rng.choice(DIRECTIONS)
         shot = 1
-        return get_action_str(vert=vert, hori=hori, shot=shot)
+        hold = 1
+        if cfg.max_hold > 1:
+            hold = self.rng.randint(1, cfg.max_hold)
+        return get_action_str(vert=vert, hori=hori, shot=shot, hold=hold)
 
     def generate_candidate(self, size):
         candidate = [self.sample_action(count=i) for i in range(size)]
@@ -330,7 +471,16 @@ class Exy:
 
     def mutate(self, individual):
         spot = self.rng.randint(0, len(individual) - 1)
-        individual[spot] = self.sample_action()
+        if cfg.max_hold > 1 and self.rng.random() < HOLD_MUTPB:
+            # Stretch or shorten the macro action, keeping its inputs
+            inputs, hold = split_action(individual[spot].split(';')[0])
+            hold += self.rng.choice((-1, 1))
+            hold = min(max(hold, 1), cfg.max_hold)
+            if hold > 1:
+                inputs = '{}:{}'.format(inputs, hold)
+            individual[spot] = inputs
+        else:
+            individual[spot] = self.sample_action()
         return individual,
 
     def render_snap(self, snap):
@@ -345,90 +495,312 @@ class Exy:
         else:
             self.current_input_img = self.current_input.imshow(inputs)
 
-    def enqueue_plot(self, path):
-        global save_queue
-        plt.gcf().set_dpi(300)
-        canvas = plt.get_current_fig_manager().canvas
-        canvas.draw()
-        img = Image.frombytes('RGB', canvas.get_width_height(),
-                              canvas.tostring_rgb())
-        save_queue.put((img, path))
-
-    def evaluate(self, candidate):
-        global save_queue
-
-        recording = get_now_string()
-        starting_score = -1
-        for _ in range(16):
-            with self.open_ddonpach(recording) as ddonpach:
-                try:
-                    starting_score, finished = self.replay_level(ddonpach)
-                except DdonpachSyncError as err:
-                    log.error('Desync!')
-                    log.exception(err)
-                    continue
-
-                save_queue.join()
-
-                self.reset_current()
-
-                combos = []
-                finished = False
-
-                for idx, action in enumerate(candidate):
-                    ddonpach.send_action(action)
-                    observation = ddonpach.read_gamestate()
-
-                    score = observation['score']
-                    combo = observation['combo']
-
-                    snap = ddonpach.get_snap()
-                    self.render_snap(snap)
-
-                    inputs = draw_inputs(idx, candidate)
-                    self.render_inputs(inputs)
-
-                    self.current_score.plot(idx, score, 'ro', markersize=1)
-                    self.current_combo.plot(idx, combo, 'bo', markersize=1)
-
-                    out_file = '{:09}.png'.format(int(self.saved))
-                    out_file = str(self.rnd / out_file)
-                    self.frame += 1
-                    if observation['death']:
-                        img = Image.open('death.png')
-                        self.current_input.imshow(img)
-                        self.current_deaths += 1
-                        self.plot_success_rate()
+    def enqueue_plot(self):
+        with metrics.timer('exy.draw'):
+            plt.gcf().set_dpi(300)
+            canvas = plt.get_current_fig_manager().canvas
+            canvas.draw()
+            img = Image.frombytes('RGB', canvas.get_width_height(),
+                                  canvas.tostring_rgb())
+
+        with metrics.timer('exy.enqueue'):
+            self.frames.write(img)
+
+    def render_step(self, ddonpach, idx, candidate, score, combo):
+        # Includes fetching the frame, which is also timed on its own.
+        with metrics.timer('exy.plot'):
+            if idx % cfg.frame_sample == 0:
+                snap = ddonpach.get_frame()
+                self.render_snap(snap)
+
+            inputs = draw_inputs(idx, candidate)
+            self.render_inputs(inputs)
+
+            self.current_score.plot(idx, score, 'ro', markersize=1)
+            self.current_combo.plot(idx, combo, 'bo', markersize=1)
+
+    def save_plot(self):
+        self.enqueue_plot()
+
+    def count_outcome(self, death, display):
+        with self.stats_lock:
+            if death:
+                self.current_deaths += 1
+            else:
+                self.current_success += 1
 
-                        self.enqueue_plot(out_file)
-                        self.saved += 1
-                        return -100 / (idx + 1), -100 / (idx + 1), False
-                    else:
-                        if self.frame % 8 == 0:
-                            self.enqueue_plot(out_file)
-                            self.saved += 1
+        if display:
+            if death:
+                img = Image.open('death.png')
+                self.current_input.imshow(img)
+
+            self.plot_success_rate()
+
+            if death:
+                self.save_plot()
+
+    def play_steps(self, ddonpach, candidate, trace):
+        """
+        Plays the given candidate one action at a time so every step can be
+        drawn, yielding the score, combo, death, score screen and danger
+        values after each of its actions and appending them to the given
+        trace.
+        """
+        index = DangerIndex() if cfg.danger_weight else None
+        for idx, action in enumerate(candidate):
+            # Genes of earlier generations carry their score after the action.
+            ddonpach.send_action(action.split(';')[0])
+            observation = ddonpach.read_gamestate()
+
+            score = observation['score']
+            combo = observation['combo']
+            self.render_step(ddonpach, idx, candidate, score, combo)
+
+            danger = index.measure(observation) if index else 0
+            step = (score, combo, observation['death'],
+                    observation['scoreScreen'], danger)
+            trace.append(step)
+            yield step
+
+    def resume_rollout(self, ddonpach, actions, start):
+        """
+        Plays the given actions as rollouts, resuming from the deepest cached
+        savestate of a prefix of them if there is one. Every `cache_stride`
+        actions, a savestate is handed to the prefix cache. Returns the score
+        at the start of the window and the list of score, combo, death, score
+        screen and danger values after each action.
+
+        Danger is only measured if `danger_weight` is set and 0 otherwise.
+        Movement is not known across a resumed savestate, so the first step
+        after one is measured by proximity alone.
+        """
+        cache = self.prefix_cache
+        trace, depth, state = cache.resume_point(actions)
+        if state:
+            ddonpach.send_load_state(state)
+            starting_score = cache.starting_score
+        else:
+            ddonpach.send_load_state(self.checkpoint_path(start))
+            starting_score, _ = self.replay_level(ddonpach, start=start)
+            cache.starting_score = starting_score
+
+        index = DangerIndex() if cfg.danger_weight else None
+        observe = index.observe if index else None
+
+        stride = cfg.cache_stride or len(actions)
+        while depth < len(actions):
+            if self.probably_hopeless(trace, len(actions) - depth):
+                cache.count_pruned(len(actions) - depth)
+                metrics.count('exy.pruned')
+                metrics.count('exy.pruned_steps', len(actions) - depth)
+                break
+
+            end = min((depth // stride + 1) * stride, len(actions))
+            steps, state = ddonpach.send_rollout(actions[depth:end],
+                                                 observe=observe)
+
+            dangers = index.take() if index else [0] * len(steps)
+            trace.extend((s, c, d, False, danger)
+                         for (s, c, d, _), danger in zip(steps, dangers))
+            depth += len(steps)
+            if state['scoreScreen']:
+                score, combo, death, _, danger = trace[-1]
+                trace[-1] = (score, combo, death, True, danger)
+
+            if depth < end or state['death'] or state['scoreScreen']:
+                cache.insert(actions[:depth], trace)
+                break
+
+            path = None
+            if depth < len(actions):
+                path = cache.next_state_path()
+            if path:
+                ddonpach.send_save_state(path)
+            cache.insert(actions[:depth], trace, state=path)
+
+        return starting_score, trace
+
+    def probably_hopeless(self, trace, remaining):
+        """
+        Returns whether a candidate that led to the given trace so far is not
+        expected to beat the known best of the previous generation on the
+        score component, with `remaining` steps left to play. This is an
+        approximation rather than a bound: each remaining step is assumed to
+        gain at most `PRUNE_MARGIN` times the largest score gain seen in a
+        step of this window, which later steps may well exceed, so candidates
+        that would have beaten the known best can be cut off. Candidates cut
+        off get `PRUNED_FITNESS`, so a wrong guess only loses a candidate and
+        never ranks it above one that was played out.
+        """
+        if self.prune_bound is None or not trace:
+            return False
+
+        gain = self.prefix_cache.max_gain
+        start = self.prefix_cache.starting_score
+        if not gain or start is None:
+            return False
+
+        best = trace[-1][0] + remaining * gain * PRUNE_MARGIN
+        return (best - start) // SCORE_STEP < self.prune_bound
+
+    def play_candidate(self, ddonpach, candidate, start, display=True):
+        actions = [action.split(';')[0] for action in candidate]
+
+        if not display:
+            starting_score, trace = self.resume_rollout(ddonpach, actions,
+                                                        start)
+            fitness = self.score_steps(candidate, starting_score, trace, False)
+            return fitness, trace
+
+        ddonpach.send_load_state(self.checkpoint_path(start))
+        starting_score, _ = self.replay_level(ddonpach, start=start)
+        self.prefix_cache.starting_score = starting_score
 
-                    combos.append(combo)
+        self.reset_current()
 
-                    action = action.split(';')[0]
-                    candidate[idx] = '{};{}'.format(action, score)
+        trace = []
+        steps = self.play_steps(ddonpach, candidate, trace)
+        fitness = self.score_steps(candidate, starting_score, steps, True)
+        self.prefix_cache.insert(actions, trace)
+        return fitness, trace
+
+    def play_remote(self, candidate, actions, start):
+        starting_score, trace = self.remote.evaluate(
+            self.checkpoint_path(start), self.level, start, self.read_fixed(),
+            actions, danger=bool(cfg.danger_weight))
+        self.prefix_cache.starting_score = starting_score
+        self.prefix_cache.insert(actions, trace)
+        fitness = self.score_steps(candidate, starting_score, trace, False)
+        return fitness, trace
+
+    def score_steps(self, candidate, starting_score, steps, display):
+        """
+        Computes the fitness of the given candidate from the score, combo,
+        death, score screen and danger values after each of its steps,
+        recording the reached scores in the candidate's actions. Actions that
+        were not played, such as those after the score screen, lose any score
+        they carried over from an earlier evaluation. Candidates cut off by
+        `probably_hopeless` before their last action get `PRUNED_FITNESS`.
+        With a `danger_weight`, the average danger scaled by it is subtracted
+        from the combo component, so candidates of equal score increase that
+        stay clear of bullets and enemies are preferred.
+        """
+        combos = []
+        dangers = []
+        finished = False
+
+        for idx, step in enumerate(steps):
+            score, combo, death, score_screen, danger = step
+            if display:
+                self.frame += 1
+
+            if death:
+                self.count_outcome(True, display)
+                return -100 / (idx + 1), -100 / (idx + 1), False
+
+            if display and self.frame % 8 == 0:
+                self.save_plot()
+
+            combos.append(combo)
+            dangers.append(danger)
+
+            action = candidate[idx].split(';')[0]
+            candidate[idx] = '{};{}'.format(action, score)
+
+            if score_screen:
+                finished = True
+                break
+
+        for idx in range(len(combos), len(candidate)):
+            candidate[idx] = candidate[idx].split(';')[0]
+
+        if not finished and len(combos) < len(candidate):
+            # Cut off as probably hopeless, its outcome is unknown.
+            return PRUNED_FITNESS
+
+        self.count_outcome(False, display)
+
+        increase = score - starting_score
+        increase //= SCORE_STEP
+        if combos[-1] > 0:
+            combo = int(np.average(combos))
+        else:
+            combo = -1
 
-                    if observation['scoreScreen']:
-                        finished = True
-                        break
+        if cfg.danger_weight:
+            combo -= cfg.danger_weight * float(np.average(dangers))
 
-                self.current_success += 1
-                self.plot_success_rate()
+        return increase, combo, finished
 
-                increase = score - starting_score
-                increase //= 5000
-                if combos[-1] > 0:
-                    return increase, int(np.average(combos)), finished
-                else:
-                    return increase, -1, finished
+    def evaluate(self, candidate):
+        actions = [action.split(';')[0] for action in candidate]
+        with metrics.timer('exy.evaluate'):
+            fitness, trace = self.evaluate_actions(candidate, actions)
+        self.traces.record(self.level, self.fixed_steps, self.generation,
+                           actions, trace, fitness)
+        return fitness
+
+    def evaluate_actions(self, candidate, actions):
+        # Candidates whose outcome is fully determined by already evaluated
+        # prefixes do not need the emulator at all.
+        trace = self.prefix_cache.complete_trace(actions)
+        if trace is not None:
+            metrics.count('exy.cached')
+            starting_score = self.prefix_cache.starting_score
+            fitness = self.score_steps(candidate, starting_score, trace, False)
+            return fitness, trace
+
+        start = self.find_checkpoint(self.fixed_steps)
+        for _ in range(16):
+            try:
+                if self.remote:
+                    return self.play_remote(candidate, actions, start)
+
+                with self.pool.session() as ddonpach:
+                    # Only the first instance draws progress plots, since
+                    # matplotlib cannot be driven from several threads.
+                    display = ddonpach is self.pool.sessions[0]
+                    display = display and not self.headless
+                    return self.play_candidate(ddonpach, candidate, start,
+                                               display=display)
+            except DdonpachSyncError as err:
+                metrics.count('exy.desyncs')
+                log.error('Desync!')
+                log.exception(err)
+            except (OSError, ValueError) as err:
+                metrics.count('exy.crashes')
+                log.error('MAME session crashed!')
+                log.exception(err)
 
         # If we reach this, the replay desynced 16 times.
-        return -10000, -10000, False
+        return (-10000, -10000, False), []
+
+    def emit_metrics(self):
+        """
+        Collects the frame timings of every running instance and emits the
+        metrics gathered during the current generation to the log and a file
+        in the mtr directory.
+        """
+        if not metrics.enabled:
+            return
+
+        # Sessions are checked out like for evaluations, so a broken one is
+        # restarted. The pool hands free sessions out in the order they were
+        # given back, so this visits each of them once.
+        for _ in range(len(self.pool.sessions)):
+            try:
+                with self.pool.session() as ddonpach:
+                    timing = ddonpach.send_frame_timing(True)
+            except (OSError, ValueError) as err:
+                log.warning('Could not collect frame timing: %s', err)
+                continue
+            metrics.merge('plugin.update', timing['frames'], timing['total'],
+                          timing['max'])
+
+        name = '{:03}-{:06}-{:02}.json'.format(self.level, self.fixed_steps,
+                                               self.generation)
+        metrics.emit(str(self.mtr / name), level=self.level,
+                     fixed=self.fixed_steps, generation=self.generation)
 
     def plot_success_rate(self):
         total = self.current_success + self.current_deaths
@@ -436,7 +808,9 @@ class Exy:
         self.success_rate.pie(rate, colors=['g', 'r'])
 
     def evaluate_population(self, pop):
-        fitnesses = list(map(self.toolbox.evaluate, pop))
+        # The scheduler hands each candidate to whichever pooled emulator
+        # instance is free and yields the fitnesses in population order.
+        fitnesses = list(self.scheduler.map(self.toolbox.evaluate, pop))
         for ind, fit in zip(pop, fitnesses):
             ind.fitness.values = fit
 
@@ -456,76 +830,251 @@ class Exy:
                 self.toolbox.mutate(mutant)
                 del mutant.fitness.values
 
-    def evolution_step(self):
-        self.reset_best()
-
-        self.current_deaths = 0
-        self.current_success = 0
-
-        gen = 0
+    def plot_generation_title(self, gen):
+        if self.headless:
+            return
 
         title = '{} steps fixed, generation {}/{}'
         title = title.format(self.fixed_steps, gen, GENS)
         self.reset_game_plot(title)
 
+    def plot_generation_best(self, gen, score, combo):
+        if self.headless:
+            return
+
+        self.best_score.plot(gen, score, 'ro', markersize=1)
+        self.best_combo.plot(gen, combo, 'bo', markersize=1)
+
+    def first_generation(self):
+        """
+        Evaluates a fresh population for the current window and returns it
+        along with its best individual.
+        """
+        self.current_deaths = 0
+        self.current_success = 0
+
+        self.generation = 0
+        self.plot_generation_title(0)
+
         pop = self.toolbox.population(n=POP)
 
         self.evaluate_population(pop)
+        self.emit_metrics()
+
+        best_ind = get_best_individual(pop)
+
+        self.plot_generation_best(0, best_ind.fitness.values[0],
+                                  best_ind.fitness.values[1])
+
+        return pop, best_ind
+
+    def next_generation(self, pop, known_best):
+        """
+        Breeds and evaluates the next generation of the given population,
+        replacing it in place, and returns the best individual known so far.
+        """
+        gen = self.generation
+        self.plot_generation_title(gen)
+
+        offspring = self.mate_population(pop)
+        self.mutate_offspring(offspring)
+        if random.random() < 0.25:
+            print('Introducing random candidate.')
+            intro = self.generate_candidate(Exy.size)
+            offspring.append(intro)
+            offspring = offspring[1:]
+
+        # Candidates not expected to reach the known best's score anymore are
+        # cut off. This is lossy, see `probably_hopeless`.
+        if cfg.approx_prune:
+            self.prune_bound = known_best.fitness.values[0]
+
+        invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
+        self.evaluate_population(invalid_ind)
+        self.prefix_cache.log_stats()
+        self.traces.flush()
+        self.emit_metrics()
 
         best_ind = get_best_individual(pop)
+        if best_ind.fitness.values > known_best.fitness.values:
+            known_best = best_ind
 
-        self.best_score.plot(gen, best_ind.fitness.values[0],
-                             'ro', markersize=1)
-        self.best_combo.plot(gen, best_ind.fitness.values[1],
-                             'bo', markersize=1)
+        score = known_best.fitness.values[0]
+        combo = known_best.fitness.values[1]
 
-        known_best = best_ind
+        self.plot_generation_best(gen, score, combo)
 
-        while gen < GENS:
-            gen += 1
+        pop[:] = offspring
+        return known_best
 
-            title = '{} steps fixed, generation {}/{}'
-            title = title.format(self.fixed_steps, gen, GENS)
-            self.reset_game_plot(title)
+    def start_window(self):
+        self.prefix_cache.clear()
+        self.prune_bound = None
 
-            offspring = self.mate_population(pop)
-            self.mutate_offspring(offspring)
-            if random.random() < 0.25:
-                print('Introducing random candidate.')
-                intro = self.generate_candidate(Exy.size)
-                offspring.append(intro)
-                offspring = offspring[1:]
+    def evolution_step(self):
+        if not self.headless:
+            self.reset_best()
+        self.start_window()
 
-            invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-            self.evaluate_population(invalid_ind)
+        if cfg.islands > 1:
+            return self.evolve_islands()
 
-            best_ind = get_best_individual(pop)
-            if best_ind.fitness.values > known_best.fitness.values:
-                known_best = best_ind
+        resumed = self.take_resumed()
+        if resumed:
+            pop, known_best, gen = resumed
+        else:
+            pop, known_best = self.first_generation()
+            gen = 0
+            self.save_evolution(pop, known_best)
 
-            score = known_best.fitness.values[0]
-            combo = known_best.fitness.values[1]
-            finished = known_best.fitness.values[2]
+        while gen < GENS:
+            gen += 1
+            self.generation = gen
 
-            self.best_score.plot(gen, score, 'ro', markersize=1)
-            self.best_combo.plot(gen, combo, 'bo', markersize=1)
+            known_best = self.next_generation(pop, known_best)
+            self.save_evolution(pop, known_best)
 
-            pop[:] = offspring
+        return known_best, known_best.fitness.values[2]
 
+    def evolve_islands(self):
+        """
+        Evolves the current window on `islands` populations in separate
+        processes, which exchange their best individuals every
+        `migration_interval` generations. Returns the best individual found
+        on any island.
+        """
+        if self.resumed:
+            log.info('Island populations are not checkpointed, so the '
+                     'window starts over.')
+            self.resumed = None
+
+        if not self.islands:
+            self.islands = Islands(self.cwd, cfg.islands)
+
+        seed = self.rng.getrandbits(32)
+        packed = self.islands.evolve(self.level, seed, GENS,
+                                     cfg.migration_interval)
+        known_best = self.unpack_individual(packed)
         return known_best, known_best.fitness.values[2]
 
+    def pack_individual(self, ind):
+        fitness = ind.fitness.values if ind.fitness.valid else None
+        return list(ind), fitness
+
+    def unpack_individual(self, packed):
+        genes, fitness = packed
+        ind = self.individual(genes)
+        if fitness is not None:
+            ind.fitness.values = fitness
+        return ind
+
+    def seed(self, seed):
+        """
+        Seeds every random generator the evolution draws from with the given
+        seed. Besides this instance's own, DEAP's selection and crossover
+        draw from the global generator.
+        """
+        self.rng.seed(seed)
+        random.seed(seed)
+
+    def get_rng_state(self):
+        """
+        Returns the states of the generators seeded by `seed`.
+        """
+        return self.rng.getstate(), random.getstate()
+
+    def set_rng_state(self, state):
+        """
+        Restores generator states previously returned by `get_rng_state`.
+        """
+        own, shared = state
+        self.rng.setstate(own)
+        random.setstate(shared)
+
+    def save_evolution(self, pop, known_best):
+        """
+        Atomically writes the complete state of the running evolution to the
+        evolution checkpoint, so `resume` can continue right after the last
+        finished generation.
+        """
+        state = {
+            'level': self.level,
+            'fixed': self.fixed_steps,
+            'generation': self.generation,
+            'pop': [self.pack_individual(ind) for ind in pop],
+            'known_best': self.pack_individual(known_best),
+            'deaths': self.current_deaths,
+            'success': self.current_success,
+            'frame': self.frame,
+            'prune_bound': self.prune_bound,
+            'max_gain': self.prefix_cache.max_gain,
+        }
+        state['rng'], state['random'] = self.get_rng_state()
+
+        tmp_path = self.evo.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as out_file:
+            pickle.dump(state, out_file)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(tmp_path, self.evo)
+
+    def resume(self):
+        """
+        Loads the evolution checkpoint, if there is one, and continues at its
+        level. The saved population is picked up by the next evolution step,
+        as long as the fixed steps of the level did not change since.
+        """
+        if not self.evo.exists():
+            log.info('No evolution checkpoint to resume from.')
+            return
+
+        with open(self.evo, 'rb') as in_file:
+            self.resumed = pickle.load(in_file)
+
+        self.level = self.resumed['level'] - 1
+        self.inc_level(ensure=True)
+        self.frame = self.resumed['frame']
+        log.info('Resuming level %s at generation %s.', self.level,
+                 self.resumed['generation'])
+
+    def take_resumed(self):
+        """
+        Returns the population, best individual and generation of the loaded
+        evolution checkpoint if it belongs to the current window, restoring
+        the rest of its state. Returns None otherwise.
+        """
+        state = self.resumed
+        self.resumed = None
+        if not state:
+            return None
+
+        if (state['level'], state['fixed']) != (self.level, self.fixed_steps):
+            log.info('Evolution checkpoint is from a finished window.')
+            return None
+
+        self.generation = state['generation']
+        self.current_deaths = state['deaths']
+        self.current_success = state['success']
+        # Keeps pruning from the first resumed generation on.
+        self.prune_bound = state.get('prune_bound')
+        self.prefix_cache.max_gain = state.get('max_gain', 0)
+        self.set_rng_state((state['rng'], state['random']))
+
+        pop = [self.unpack_individual(packed) for packed in state['pop']]
+        known_best = self.unpack_individual(state['known_best'])
+        return pop, known_best, self.generation
+
     def backtrack(self):
-        with open(self.current_fxd, 'r') as fixed:
-            lines = fixed.readlines()
+        fixed = FixedLog(self.current_fxd)
 
-        if len(lines) >= Exy.size:
-            lines = lines[:len(lines) - Exy.size // 2]
+        steps = len(fixed)
+        if steps >= Exy.size:
+            steps -= Exy.size // 2
         else:
-            lines = []
+            steps = 0
 
-        with open(self.current_fxd, 'w') as fixed:
-            for line in lines:
-                fixed.write('{}'.format(line))
+        fixed.truncate(steps)
+        self.drop_checkpoints(steps)
 
     def progression_level(self):
         while True:
@@ -533,12 +1082,19 @@ class Exy:
             best, finished = self.evolution_step()
             score = best.fitness.values[0]
             if score >= 0:
-                with open(self.current_fxd, 'a') as fixed:
-                    for line in best:
-                        fixed.write('{}\n'.format(line))
+                steps = []
+                for gene in best:
+                    # Only the played prefix of the window has scores.
+                    if ';' not in gene:
+                        break
+                    action, score = gene.split(';')
+                    steps.append((action, int(score)))
+                FixedLog(self.current_fxd).extend(steps)
 
                 if finished:
                     break
+
+                self.save_checkpoint()
             else:
                 self.backtrack()
 
@@ -548,23 +1104,26 @@ class Exy:
             self.advance_level()
 
     def replay(self, recording):
+        convert_directory(self.fxd)
         with self.open_ddonpach(recording) as ddonpach:
-            for _ in self.fxd.iterdir():
+            for _ in self.fxd.glob('*.fxd'):
                 self.replay_level(ddonpach)
                 self.inc_level()
 
 
-def evolve(cwd):
-    global finished
-
-    thread = threading.Thread(target=saver)
-    thread.start()
-
-    e = Exy(cwd)
-    e.progression()
-    finished = True
+def evolve(cwd, headless=False, resume=False):
+    e = Exy(cwd, headless=headless)
+    try:
+        if resume:
+            e.resume()
+        e.progression()
+    finally:
+        e.close()
 
 
 def replay(cwd, recording):
     e = Exy(cwd)
-    e.replay(recording)
+    try:
+        e.replay(recording)
+    finally:
+        e.close()
@@ -0,0 +1,407 @@
+"""
+This module implements a stand-in for MAME running the dodonbotchi plugin,
+for measuring DoDonBotchi's own overhead on machines without MAME or the ROM.
+It connects back to the given host and port like the plugin and speaks the
+same protocol, but plays a scripted synthetic game instead of DoDonPachi.
+
+The synthetic game is fully determined by its seed and the inputs it gets, so
+savestates, replays and cached prefixes behave like they do with the real
+game. Scores, deaths and objects follow from hashing the frame number and ship
+position; the amount of objects per class is configurable to measure the cost
+of large game states.
+"""
+import json
+import os
+import socket
+import sys
+
+import click
+import numpy as np
+
+from dodonbotchi.ipc import SocketStream
+from dodonbotchi.wire import HEADER, OBJECT_CLASSES, OBJECT_DTYPE
+from dodonbotchi.wire import SHIP_SIZE, WIRE_BINARY
+
+FAKE_OBJECTS = 16
+FAKE_MAIN = 'from dodonbotchi.fakemame import main; main()'
+LEVEL_FRAMES = 20000
+DEATH_RATE = 4096  # One in this many frames kills the ship on average
+
+SCREEN_WIDTH = 320
+SCREEN_HEIGHT = 240
+
+MAX_COMBO = 0x37  # Same as in dodonbotchi.mame
+
+# Multiples of the object count each object class holds
+CLASS_SCALES = {
+    'enemies': 1,
+    'bullets': 2,
+    'ownshot': 1,
+    'bonuses': 0.5,
+    'powerup': 0.125,
+}
+
+
+def split_action(action):
+    """
+    Splits macro actions like `splitAction` in the plugin's controller.
+    """
+    inputs, _, ticks = action.partition(':')
+    return inputs, int(ticks) if ticks else 1
+
+
+def mix(*values):
+    """
+    Cheap deterministic hash of the given integers to 32 bits.
+    """
+    acc = 0x9E3779B9
+    for value in values:
+        acc = ((acc ^ (value & 0xFFFFFFFF)) * 0x01000193) & 0xFFFFFFFF
+        acc ^= acc >> 15
+    return acc
+
+
+class FakeGame:
+    """
+    Synthetic stand-in for the game's memory. Its whole state is a handful of
+    integers, which savestates store as json.
+    """
+
+    def __init__(self, seed=0, objects=FAKE_OBJECTS):
+        self.seed = seed
+        self.counts = {name: int(objects * scale)
+                       for name, scale in CLASS_SCALES.items()}
+        self.reset()
+
+    def reset(self):
+        """
+        Starts a fresh game.
+        """
+        self.frame = 0
+        self.score = 0
+        self.combo = 0
+        self.hit = 0
+        self.lives = 3
+        self.bombs = 3
+        self.ship_x = SCREEN_WIDTH // 2
+        self.ship_y = SCREEN_HEIGHT - 32
+        self.death = False
+
+        self.inputs = '0000'
+
+    def save(self, path):
+        # MAME creates missing directories of savestates on its own.
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        values = {key: getattr(self, key) for key in (
+            'seed', 'frame', 'score', 'combo', 'hit', 'lives', 'bombs',
+            'ship_x', 'ship_y', 'death', 'inputs')}
+        with open(path, 'w') as out_file:
+            json.dump(values, out_file)
+
+    def load(self, path):
+        with open(path, 'r') as in_file:
+            values = json.load(in_file)
+        for key, value in values.items():
+            setattr(self, key, value)
+
+    def score_screen(self):
+        return self.frame >= LEVEL_FRAMES
+
+    def step(self):
+        """
+        Emulates one frame with the current inputs.
+        """
+        self.frame += 1
+        if self.death or self.score_screen():
+            return
+
+        vert, hori, shot, _ = (int(digit) for digit in self.inputs)
+        # 1 moves up or left, 2 down or right
+        self.ship_y += {0: 0, 1: -2, 2: 2}[vert]
+        self.ship_x += {0: 0, 1: -2, 2: 2}[hori]
+        self.ship_x = min(max(self.ship_x, 0), SCREEN_WIDTH - 1)
+        self.ship_y = min(max(self.ship_y, 0), SCREEN_HEIGHT - 1)
+
+        roll = mix(self.seed, self.frame, self.ship_x // 8, self.ship_y // 8)
+        if self.frame > 60 and roll % DEATH_RATE == 0:
+            self.death = True
+            return
+
+        if shot:
+            self.score += (roll % 7) * 10
+            if roll % 5:
+                self.combo = min(self.combo + 1, MAX_COMBO)
+                self.hit += 1
+            else:
+                self.combo = 0
+        else:
+            self.combo = 0
+
+    def objects(self, name):
+        """
+        Returns the objects of the given class as a structured array.
+        """
+        count = self.counts[name]
+        objects = np.zeros(count, dtype=OBJECT_DTYPE)
+        slots = np.arange(count)
+        salt = mix(self.seed, OBJECT_CLASSES.index(name))
+        objects['slot'] = slots
+        objects['id'] = (slots + salt) % 0xFFFF + 1
+        objects['sid'] = 0x200000 + slots * 0x10
+        objects['pos_x'] = (slots * 37 + salt + self.frame) % SCREEN_WIDTH
+        objects['pos_y'] = (slots * 91 + salt + self.frame * 2) % SCREEN_HEIGHT
+        objects['siz_x'] = 16
+        objects['siz_y'] = 16
+        objects['mode'] = 0x0101
+        return objects
+
+    def scalars(self):
+        return {
+            'x_off': 0,
+            'frame': self.frame,
+            'death': self.death,
+            'lives': self.lives,
+            'bombs': self.bombs,
+            'score': self.score,
+            'combo': self.combo,
+            'hit': self.hit,
+            'scoreScreen': self.score_screen(),
+        }
+
+    def json_state(self):
+        state = self.scalars()
+        state['ship'] = [{
+            'pos_x': self.ship_x,
+            'pos_y': self.ship_y,
+            'siz_x': SHIP_SIZE,
+            'siz_y': SHIP_SIZE,
+        }]
+        for name in OBJECT_CLASSES:
+            keys = OBJECT_DTYPE.names
+            state[name] = [dict(zip(keys, map(int, obj)))
+                           for obj in self.objects(name)]
+        return state
+
+    def binary_state(self):
+        scalars = self.scalars()
+        header = HEADER.pack(
+            scalars['x_off'], scalars['frame'], int(scalars['death']),
+            scalars['lives'], scalars['bombs'], scalars['score'],
+            scalars['combo'], scalars['hit'], int(scalars['scoreScreen']),
+            self.ship_x, self.ship_y,
+            *(self.counts[name] for name in OBJECT_CLASSES))
+        parts = [header]
+        parts.extend(self.objects(name).tobytes() for name in OBJECT_CLASSES)
+        return b''.join(parts)
+
+    def pixels(self):
+        """
+        Returns the screen as ARGB32 words in native byte order, like MAME's
+        `screen:pixels()`.
+        """
+        pixels = np.full((SCREEN_HEIGHT, SCREEN_WIDTH), 0xFF000000,
+                         dtype='<u4')
+        for name in OBJECT_CLASSES:
+            objects = self.objects(name)
+            pixels[objects['pos_y'] % SCREEN_HEIGHT,
+                   objects['pos_x'] % SCREEN_WIDTH] = 0xFFFF0000
+        pixels[self.ship_y, self.ship_x] = 0xFF00FF00
+        return pixels.tobytes()
+
+
+class FakePlugin:
+    """
+    Counterpart of the plugin's `remoteController`, answering commands from
+    the given stream by advancing the given game.
+    """
+
+    def __init__(self, stream, game, tick_rate=2, state_dir='.'):
+        self.stream = stream
+        self.game = game
+        self.tick_rate = tick_rate
+        self.state_dir = state_dir
+        self.wire_format = 'json'
+
+    def send(self, message, payload=None):
+        self.stream.write('{}\n'.format(json.dumps(message)).encode('utf-8'))
+        if payload is not None:
+            self.stream.write(payload)
+
+    def send_ack(self):
+        self.send({'message': 'ACK'})
+
+    def send_state(self, message):
+        if self.wire_format == WIRE_BINARY:
+            payload = self.game.binary_state()
+            message['format'] = WIRE_BINARY
+            message['size'] = len(payload)
+            self.send(message, payload)
+        else:
+            message['state'] = self.game.json_state()
+            self.send(message)
+
+    def advance(self, frames):
+        for _ in range(frames):
+            self.game.step()
+
+    def perform(self, inputs, ticks=1):
+        """
+        Plays the given inputs for the given amount of ticks, stopping early
+        if the ship dies or the level ends like the plugin does.
+        """
+        game = self.game
+        game.inputs = inputs
+        for _ in range(ticks):
+            self.advance(self.tick_rate)
+            if game.death or game.score_screen():
+                break
+
+    def state_path(self, name):
+        if os.path.isabs(name):
+            return name
+        return os.path.join(self.state_dir, '{}.sta'.format(name))
+
+    def wait_until(self, message):
+        game = self.game
+        condition = message['condition']
+        value = message['value']
+        limit = message.get('limit') or 0
+
+        elapsed = 0
+        while not limit or elapsed < limit:
+            game.step()
+            elapsed += 1
+
+            if condition == 'frames':
+                done = elapsed >= value
+            elif condition == 'frame':
+                done = game.frame >= value
+            elif condition == 'scoreScreen':
+                done = game.score_screen() == value
+            elif condition == 'death':
+                done = game.death == value
+            else:
+                # The synthetic game has no memory to compare against.
+                done = True
+
+            if done:
+                break
+
+        self.send_state({'message': 'gamestate'})
+
+    def rollout(self, actions, observe=False):
+        trace = []
+        game = self.game
+        for idx, action in enumerate(actions):
+            self.perform(*split_action(action))
+            trace.append((game.score, game.combo, int(game.death), game.frame))
+            if game.death or game.score_screen():
+                break
+            if observe and idx < len(actions) - 1:
+                self.send_state({'message': 'rolloutStep'})
+
+        self.send_state({'message': 'rollout', 'trace': trace})
+
+    def handle(self, message):
+        """
+        Handles one command and returns False once the client asked to quit.
+        """
+        command = message['command']
+        if command == 'kill':
+            return False
+
+        if command == 'format':
+            self.wire_format = message['format']
+            self.send_ack()
+        elif command == 'action':
+            self.game.inputs = message['inputs']
+            self.advance(self.tick_rate)
+            self.send_state({'message': 'gamestate'})
+        elif command == 'hold':
+            self.perform(message['inputs'], message['ticks'])
+            self.send_state({'message': 'gamestate'})
+        elif command == 'rollout':
+            self.rollout(message['actions'], message.get('observe'))
+        elif command == 'wait':
+            self.wait_until({'condition': 'frames',
+                             'value': message['frames']})
+        elif command == 'waitScore':
+            self.wait_until({'condition': 'scoreScreen', 'value': False})
+        elif command == 'waitUntil':
+            self.wait_until(message)
+        elif command == 'snap':
+            self.send_ack()
+        elif command == 'timing':
+            # There are no frame callbacks to time here.
+            timing = {'frames': 0, 'total': 0, 'max': 0}
+            self.send({'message': 'timing', 'timing': timing})
+        elif command == 'frame':
+            pixels = self.game.pixels()
+            self.send({'message': 'frame', 'width': SCREEN_WIDTH,
+                       'height': SCREEN_HEIGHT, 'size': len(pixels)}, pixels)
+        elif command == 'save':
+            self.game.save(self.state_path(message['name']))
+            self.send_ack()
+        elif command == 'load':
+            path = self.state_path(message['name'])
+            if os.path.exists(path):
+                self.game.load(path)
+            else:
+                # Unknown states start a fresh game instead of failing, so
+                # benchmarks do not need a prepared level savestate.
+                self.game.reset()
+            self.game.inputs = '0000'
+            self.send_ack()
+
+        return True
+
+    def serve(self):
+        while True:
+            try:
+                line = self.stream.readline()
+            except ConnectionError:
+                return
+            if not self.handle(json.loads(line)):
+                return
+
+
+def fake_call(host, port, state=None, objects=FAKE_OBJECTS, tick_rate=2,
+              seed=0):
+    """
+    Returns the command line starting a fake MAME connecting to the given
+    host and port.
+    """
+    # Not started with -m, since the package already imports this module.
+    call = [sys.executable, '-c', FAKE_MAIN,
+            '--host', host, '--port', str(port),
+            '--objects', str(objects), '--tick-rate', str(tick_rate),
+            '--seed', str(seed)]
+    if state:
+        call.extend(['--state', state])
+    return call
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', type=int, required=True)
+@click.option('--state', default=None)
+@click.option('--objects', type=int, default=FAKE_OBJECTS)
+@click.option('--tick-rate', type=int, default=2)
+@click.option('--seed', type=int, default=0)
+def main(host, port, state, objects, tick_rate, seed):
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    game = FakeGame(seed=seed, objects=objects)
+    plugin = FakePlugin(SocketStream(sock), game, tick_rate=tick_rate)
+    if state and os.path.exists(plugin.state_path(state)):
+        game.load(plugin.state_path(state))
+
+    try:
+        plugin.serve()
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    main()
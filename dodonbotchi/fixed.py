@@ -0,0 +1,204 @@
+"""
+This module implements the binary log of actions fixed in a level. Every step
+is a fixed-width record holding the action's inputs packed into a byte, the
+amount of ticks they are held for, the score reached after it and the frame
+number it ended on, following a short header.
+Knowing the record size, the amount of steps follows from the file size and
+backtracking is a truncation of the file, neither of which needs the file to
+be read. Records are read through a memory map.
+
+Logs in the older text format, one `action;score` line per step, can be
+converted with `convert_text`. Binary logs written before macro actions, which
+lack the amount of ticks, are upgraded when opened.
+"""
+import logging as log
+import os
+
+from pathlib import Path
+
+import numpy as np
+
+from dodonbotchi.mame import split_action
+
+MAGIC = b'DDPFXD'
+VERSION = 2
+HEADER_SIZE = 8
+
+RECORD_DTYPE = np.dtype([
+    ('action', 'u1'),
+    ('hold', 'u1'),
+    ('score', '<u4'),
+    ('frame', '<u4'),
+])
+
+# Records of version 1, whose actions are all held for one tick
+LEGACY_DTYPE = np.dtype([
+    ('action', 'u1'),
+    ('score', '<u4'),
+    ('frame', '<u4'),
+])
+
+ACTION_DIGITS = 4  # Vertical, horizontal, shot and bomb inputs
+ACTION_BASE = 3  # Each input is one of three states
+
+
+def pack_action(action):
+    """
+    Packs the given action string into a single byte, reading its digits as
+    a number in base 3.
+    """
+    packed = 0
+    for digit in action:
+        packed = packed * ACTION_BASE + int(digit)
+    return packed
+
+
+def unpack_action(packed, hold=1):
+    digits = []
+    for _ in range(ACTION_DIGITS):
+        packed, digit = divmod(int(packed), ACTION_BASE)
+        digits.append(str(digit))
+    action = ''.join(reversed(digits))
+    if hold > 1:
+        action = '{}:{}'.format(action, hold)
+    return action
+
+
+class FixedLog:
+    """
+    Binary log of fixed steps at the given path, created empty if it does not
+    exist yet.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+
+        if not os.path.exists(self.path):
+            with open(self.path, 'wb') as out_file:
+                out_file.write(self.header())
+            return
+
+        with open(self.path, 'rb') as in_file:
+            header = in_file.read(HEADER_SIZE)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a fixed step log: {}'.format(self.path))
+
+        version = header[len(MAGIC)]
+        if version == 1:
+            self.upgrade()
+        elif version != VERSION:
+            raise ValueError('Unsupported fixed step log version: {}'.format(
+                version))
+
+    def upgrade(self):
+        """
+        Rewrites a version 1 log at this log's path in the current format.
+        """
+        legacy = np.fromfile(self.path, dtype=LEGACY_DTYPE,
+                             offset=HEADER_SIZE)
+        records = np.zeros(len(legacy), dtype=RECORD_DTYPE)
+        for field in LEGACY_DTYPE.names:
+            records[field] = legacy[field]
+        records['hold'] = 1
+
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'wb') as out_file:
+            out_file.write(self.header())
+            out_file.write(records.tobytes())
+        os.replace(tmp_path, self.path)
+        log.info('Upgraded fixed step log: %s', self.path)
+
+    def header(self):
+        return MAGIC + bytes([VERSION, RECORD_DTYPE.itemsize])
+
+    def __len__(self):
+        size = os.path.getsize(self.path) - HEADER_SIZE
+        return size // RECORD_DTYPE.itemsize
+
+    def offset(self, index):
+        return HEADER_SIZE + index * RECORD_DTYPE.itemsize
+
+    def view(self):
+        """
+        Returns a read-only memory-mapped array of every record in the log.
+        """
+        count = len(self)
+        if not count:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        return np.memmap(self.path, dtype=RECORD_DTYPE, mode='r',
+                         offset=HEADER_SIZE, shape=(count,))
+
+    def __getitem__(self, index):
+        """
+        Returns the action, score and frame of the step at the given index.
+        """
+        record = self.view()[index]
+        action = unpack_action(record['action'], record['hold'])
+        return action, int(record['score']), int(record['frame'])
+
+    def steps(self, start=0):
+        """
+        Returns a list of (action, score) pairs of every step from the given
+        index on.
+        """
+        records = self.view()[start:]
+        actions = [unpack_action(packed, hold) for packed, hold
+                   in zip(records['action'], records['hold'])]
+        return list(zip(actions, records['score'].tolist()))
+
+    def extend(self, steps):
+        """
+        Appends the given (action, score) or (action, score, frame) tuples.
+        """
+        records = np.zeros(len(steps), dtype=RECORD_DTYPE)
+        for record, step in zip(records, steps):
+            inputs, hold = split_action(step[0])
+            record['action'] = pack_action(inputs)
+            record['hold'] = hold
+            record['score'] = step[1]
+            if len(step) > 2:
+                record['frame'] = step[2]
+
+        with open(self.path, 'ab') as out_file:
+            out_file.write(records.tobytes())
+
+    def append(self, action, score, frame=0):
+        self.extend([(action, score, frame)])
+
+    def truncate(self, count):
+        """
+        Drops every step after the first `count` ones.
+        """
+        os.truncate(self.path, self.offset(min(count, len(self))))
+
+
+def convert_text(txt_path, fxd_path):
+    """
+    Converts the text log of fixed steps at the given path to a binary log at
+    the other given path, which must not exist yet.
+    """
+    steps = []
+    with open(txt_path, 'r') as in_file:
+        for line in in_file:
+            if line.strip():
+                action, score = line.split(';')
+                steps.append((action, int(score)))
+
+    fixed = FixedLog(fxd_path)
+    if len(fixed):
+        raise ValueError('Fixed step log already exists: {}'.format(fxd_path))
+    fixed.extend(steps)
+    return fixed
+
+
+def convert_directory(fxd_dir):
+    """
+    Converts every text log of fixed steps in the given directory that has no
+    binary counterpart yet.
+    """
+    for txt_path in sorted(Path(fxd_dir).glob('*.txt')):
+        fxd_path = txt_path.with_suffix('.fxd')
+        if fxd_path.exists():
+            continue
+        fixed = convert_text(txt_path, fxd_path)
+        log.info('Converted %s fixed steps from: %s', len(fixed), txt_path)
@@ -0,0 +1,150 @@
+"""
+This module implements the Python end of the framing used between DoDonBotchi
+and its MAME plugin. Messages are json objects terminated by a newline, which
+json never contains unescaped, and may be followed by a binary payload whose
+size the message announces. Both ends buffer incoming data until a full frame
+is available, so messages of any size survive being split across or merged
+into socket reads.
+"""
+import socket
+import threading
+import time
+
+READ_SIZE = 1 << 16
+
+BENCH_MESSAGES = 20000
+BENCH_PAYLOAD = 2048
+
+
+class SocketStream:
+    """
+    Buffered reader and writer around a connected socket, reading directly
+    with `recv_into` instead of going through `socket.makefile`. Offers the
+    subset of the file interface the client code needs.
+    """
+
+    def __init__(self, sock, read_size=READ_SIZE):
+        self.sock = sock
+        self.read_size = read_size
+        self.buffer = bytearray()
+        self.pos = 0
+        self.chunk = bytearray(read_size)
+
+        self.received = 0
+        self.sent = 0
+
+    def fill(self):
+        """
+        Reads whatever the socket has available into the buffer, dropping
+        already consumed data first. Raises a ConnectionError if the peer
+        closed the connection, so it is handled like any other socket error.
+        """
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+
+        count = self.sock.recv_into(self.chunk)
+        if not count:
+            raise ConnectionError('Peer closed connection.')
+        self.received += count
+        self.buffer += memoryview(self.chunk)[:count]
+
+    def readline(self):
+        """
+        Returns the next newline-terminated line, including the newline.
+        """
+        start = self.pos
+        while True:
+            eol = self.buffer.find(b'\n', start)
+            if eol >= 0:
+                line = bytes(self.buffer[self.pos:eol + 1])
+                self.pos = eol + 1
+                return line
+
+            start = len(self.buffer) - self.pos
+            self.fill()
+
+    def readinto(self, view):
+        """
+        Reads up to len(view) bytes into the given writable buffer and returns
+        the amount read. Buffered data is handed out first; beyond that, large
+        reads go straight from the socket into the target.
+        """
+        buffered = len(self.buffer) - self.pos
+        if buffered:
+            count = min(buffered, len(view))
+            view[:count] = self.buffer[self.pos:self.pos + count]
+            self.pos += count
+            return count
+
+        if len(view) >= self.read_size:
+            count = self.sock.recv_into(view)
+            self.received += count
+            return count
+
+        self.fill()
+        return self.readinto(view)
+
+    def write(self, data):
+        self.sock.sendall(data)
+        self.sent += len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.sock.close()
+
+
+def read_exactly(stream, view):
+    read = 0
+    while read < len(view):
+        count = stream.readinto(view[read:])
+        if not count:
+            raise ConnectionError('Peer closed connection mid-payload.')
+        read += count
+
+
+def benchmark(messages=BENCH_MESSAGES, payload=BENCH_PAYLOAD):
+    """
+    Measures how fast messages followed by a binary payload of the given size
+    can be read through `socket.makefile` and through `SocketStream` over a
+    local socket pair. Returns a dictionary mapping each reader's name to the
+    messages read per second.
+    """
+    line = b'{"message": "gamestate", "format": "binary", "size": %d}\n'
+    frame = (line % payload) + bytes(payload)
+
+    def produce(sock):
+        block = frame * 64
+        for _ in range(messages // 64):
+            sock.sendall(block)
+        sock.sendall(frame * (messages % 64))
+        sock.shutdown(socket.SHUT_WR)
+
+    results = {}
+    for name in ('makefile', 'stream'):
+        reader, writer = socket.socketpair()
+        if name == 'makefile':
+            stream = reader.makefile(mode='rwb')
+        else:
+            stream = SocketStream(reader)
+
+        thread = threading.Thread(target=produce, args=(writer,))
+        view = memoryview(bytearray(payload))
+
+        start = time.perf_counter()
+        thread.start()
+        for _ in range(messages):
+            stream.readline()
+            read_exactly(stream, view)
+        elapsed = time.perf_counter() - start
+
+        thread.join()
+        stream.close()
+        reader.close()
+        writer.close()
+
+        results[name] = messages / elapsed
+
+    return results
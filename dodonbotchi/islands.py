@@ -0,0 +1,190 @@
+"""
+This module implements the island model of the GA. Several populations evolve
+the same window independently, each in its own process with its own emulator
+instances and random generators, so evolution spreads over every core instead
+of waiting on a single population's emulator. Every few generations, each
+island sends copies of its best individuals to the next island in a ring,
+where they replace the worst ones.
+
+Islands are headless `Exy` instances working on the same directory as the one
+driving the progression. They share its fixed steps and checkpoints, which
+only change between windows, and keep their emulator instances, prefix caches,
+traces and metrics under `isl/NN`. Individuals cross process boundaries in
+the packed form of `Exy.pack_individual`.
+"""
+import logging as log
+import multiprocessing
+
+from dodonbotchi.config import CFG as cfg
+
+
+class Island:
+    """
+    Population of one island, evolved by the given `Exy` on request of the
+    driving process.
+    """
+
+    def __init__(self, exy):
+        self.exy = exy
+        self.pop = None
+        self.known_best = None
+
+    def ranked(self):
+        """
+        Returns the indices of the evaluated individuals of the population,
+        from worst to best. Indices rather than individuals, since individuals
+        compare equal by their actions and duplicates are common.
+        """
+        valid = [idx for idx, ind in enumerate(self.pop) if ind.fitness.valid]
+        return sorted(valid, key=lambda idx: self.pop[idx].fitness)
+
+    def report(self):
+        """
+        Returns the packed copies of this island's best individuals to send
+        to the next island and its best known individual.
+        """
+        exy = self.exy
+        migrants = self.ranked()[-cfg.migrants:] if cfg.migrants else []
+        return {
+            'migrants': [exy.pack_individual(self.pop[idx])
+                         for idx in migrants],
+            'best': exy.pack_individual(self.known_best),
+        }
+
+    def immigrate(self, migrants):
+        """
+        Replaces the worst individuals of the population with the given packed
+        immigrants.
+        """
+        worst = self.ranked()[:len(migrants)]
+        for idx, packed in zip(worst, migrants):
+            self.pop[idx] = self.exy.unpack_individual(packed)
+
+    def start(self, level, seed):
+        """
+        Starts evolving the window at the current fixed steps of the given
+        level with a fresh population.
+        """
+        exy = self.exy
+        if exy.level != level:
+            exy.level = level - 1
+            exy.inc_level()
+        exy.count_fixed_steps()
+        exy.start_window()
+
+        exy.seed(seed)
+
+        self.pop, self.known_best = exy.first_generation()
+        return self.report()
+
+    def evolve(self, generations, migrants):
+        self.immigrate(migrants)
+        for _ in range(generations):
+            self.exy.generation += 1
+            self.known_best = self.exy.next_generation(self.pop,
+                                                       self.known_best)
+        return self.report()
+
+
+def island_main(cwd, island, values, conn):
+    """
+    Entry point of an island process, serving commands from the driving
+    process over the given pipe until told to close.
+    """
+    # Imported here since exy imports this module.
+    from dodonbotchi.exy import Exy
+
+    fmt = '%(asctime)s %(levelname)-8s island {}: %(message)s'.format(island)
+    log.basicConfig(format=fmt, level=log.INFO)
+    cfg.load_values(values)
+
+    exy = Exy(cwd, headless=True, island=island)
+    try:
+        handler = Island(exy)
+        while True:
+            command, args = conn.recv()
+            if command == 'close':
+                break
+            if command == 'start':
+                conn.send(handler.start(*args))
+            elif command == 'evolve':
+                conn.send(handler.evolve(*args))
+    finally:
+        exy.close()
+        conn.close()
+
+
+class Islands:
+    """
+    Starts the given amount of island processes working in the given
+    directory and drives their evolution.
+    """
+
+    def __init__(self, cwd, count):
+        # Islands run their own emulators instead of sharing remote workers.
+        values = dict(cfg)
+        values['workers'] = []
+
+        # Spawned rather than forked, since the driving process has threads
+        # and emulator sessions of its own.
+        context = multiprocessing.get_context('spawn')
+        self.pipes = []
+        self.processes = []
+        for island in range(count):
+            parent, child = context.Pipe()
+            process = context.Process(target=island_main,
+                                      args=(str(cwd), island, values, child))
+            process.start()
+            child.close()
+            self.pipes.append(parent)
+            self.processes.append(process)
+
+        log.info('Started %s islands.', count)
+
+    def call(self, command, args):
+        """
+        Sends the given command to every island, with the respective entry of
+        `args` as its arguments, and returns their replies once all of them
+        are done.
+        """
+        for pipe, arg in zip(self.pipes, args):
+            pipe.send((command, arg))
+        return [pipe.recv() for pipe in self.pipes]
+
+    def evolve(self, level, seed, generations, interval):
+        """
+        Evolves the current window of the given level for the given amount of
+        generations on every island, migrating every `interval` generations.
+        Returns the packed best individual found on any island.
+        """
+        count = len(self.pipes)
+        interval = interval or generations
+        reports = self.call('start', [(level, seed + idx)
+                                      for idx in range(count)])
+
+        gen = 0
+        while gen < generations:
+            steps = min(interval, generations - gen)
+            # Each island receives the migrants of the one before it.
+            migrants = [reports[idx - 1]['migrants'] for idx in range(count)]
+            reports = self.call('evolve', [(steps, migrants[idx])
+                                           for idx in range(count)])
+            gen += steps
+
+            best = [report['best'][1] for report in reports]
+            log.info('Islands at generation %s/%s, best fitness: %s', gen,
+                     generations, max(best))
+
+        return max((report['best'] for report in reports),
+                   key=lambda packed: packed[1])
+
+    def close(self):
+        for pipe in self.pipes:
+            try:
+                pipe.send(('close', None))
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join()
+        for pipe in self.pipes:
+            pipe.close()
@@ -16,8 +16,12 @@ from datetime import datetime
 
 import click
 
+from dodonbotchi import bench
 from dodonbotchi import mame
 from dodonbotchi import exy
+from dodonbotchi import fixed
+from dodonbotchi import remote
+from dodonbotchi import traces
 from dodonbotchi.config import ensure_config
 from dodonbotchi.mame import RECORDING_FILE
 from dodonbotchi.util import ensure_directories
@@ -74,8 +78,46 @@ def cli(log_file=None, cfg_file=None, no_file=False):
 
 @cli.command()
 @click.argument('cwd', type=click.Path(file_okay=False))
-def progression(cwd):
-    exy.evolve(cwd)
+@click.option('--headless', is_flag=True,
+              help='Skip snapshots, plotting and frame saving.')
+@click.option('--resume', is_flag=True,
+              help='Continue from the last evolution checkpoint.')
+def progression(cwd, headless=False, resume=False):
+    exy.evolve(cwd, headless=headless, resume=resume)
+
+
+@cli.command()
+@click.argument('cwd', type=click.Path(file_okay=False))
+@click.option('--host', default='0.0.0.0')
+@click.option('--port', type=int, default=remote.WORKER_PORT)
+@click.option('--instances', type=int, default=1,
+              help='Amount of MAME instances to evaluate on.')
+def worker(cwd, host, port, instances):
+    remote.work(cwd, host, port, instances)
+
+
+@cli.command()
+@click.argument('cwd', type=click.Path(file_okay=False))
+@click.option('--every', type=int, default=traces.OBSERVE_EVERY,
+              help='Plot the curves of every n-th evaluation.')
+def observe(cwd, every):
+    traces.observe(cwd, every=every)
+
+
+@cli.command('bench')
+@click.argument('cwd', type=click.Path(file_okay=False))
+@click.option('--steps', type=int, default=bench.BENCH_STEPS)
+@click.option('--evaluations', type=int, default=bench.BENCH_EVALUATIONS)
+@click.option('--objects', type=int, default=bench.BENCH_OBJECTS,
+              help='Objects per class in the fake game state.')
+def run_bench(cwd, steps, evaluations, objects):
+    bench.run(cwd, steps=steps, evaluations=evaluations, objects=objects)
+
+
+@cli.command('convert-fixed')
+@click.argument('cwd', type=click.Path(file_okay=False, exists=True))
+def convert_fixed(cwd):
+    fixed.convert_directory(os.path.join(cwd, 'fxd'))
 
 
 @cli.command()
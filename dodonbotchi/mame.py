@@ -2,15 +2,18 @@
 This module implements classes related to giving access to MAME and DoDonPachi
 as an OpenAI-Gym-like environment.
 """
+import asyncio
 import json
 import logging as log
 import math
 import os
+import queue
 import random
-import shutil
 import socket
 import subprocess
+import threading
 
+from contextlib import contextmanager
 from time import sleep
 
 import numpy as np
@@ -19,7 +22,11 @@ from jinja2 import Environment, FileSystemLoader
 from PIL import Image
 
 from dodonbotchi.config import CFG as cfg
+from dodonbotchi.metrics import METRICS as metrics
+from dodonbotchi.ipc import SocketStream, read_exactly
 from dodonbotchi.util import ensure_directories
+from dodonbotchi.wire import WIRE_BINARY, apply_delta, decode_delta
+from dodonbotchi.wire import decode_state
 
 SHELL = os.name == 'nt'
 
@@ -27,31 +34,117 @@ RECORDING_FILE = 'recording.inp'
 
 PLUGIN_NAME = 'dodonbotchi_mame'
 
+ROLLOUT_CHUNK = 4096  # Most actions sent in one rollout command
+
+STREAM_LIMIT = 1 << 24  # Longest line accepted by asyncio streams
+STOP_TIMEOUT = 5  # Seconds MAME gets to exit after the kill command
+
+# DoDonPachi runs on a screen rotated by 270 degrees, so raw frames have to be
+# turned by 90 degrees counter-clockwise to match what MAME displays.
+FRAME_ROTATION = 1
+
 MAX_COMBO = 0x37
 MAX_DISTANCE = 400  # Furthest distance two objects can have in 240x320
 
 
-def get_action_str(vert=0, hori=0, shot=0, bomb=0):
-    return '{}{}{}{}'.format(vert, hori, shot, bomb)
+def get_action_str(vert=0, hori=0, shot=0, bomb=0, hold=1):
+    """
+    Returns the string of the action with the given inputs. Actions holding
+    their inputs for more than one tick are macro actions, which name the
+    amount of ticks after a colon.
+    """
+    action = '{}{}{}{}'.format(vert, hori, shot, bomb)
+    if hold > 1:
+        action = '{}:{}'.format(action, hold)
+    return action
+
+
+def split_action(action):
+    """
+    Returns the inputs of the given action and the amount of ticks they are
+    held for.
+    """
+    inputs, _, hold = action.partition(':')
+    return inputs, int(hold) if hold else 1
+
+
+class DdonpachSyncError(Exception):
+    pass
+
+
+def replay_fixed(ddonpach, level, fixed, start=0):
+    """
+    Replays the given list of (action, score) pairs fixed in the given level,
+    starting after the first `start` of them, on a session that has the
+    matching level savestate or checkpoint loaded. Returns the score reached
+    and whether the level was finished. Raises a `DdonpachSyncError` if the
+    replay does not reach the recorded scores.
+    """
+    if start:
+        # Resuming from a checkpoint taken in the middle of the level,
+        # so there is neither a loading nor a score screen to wait out.
+        pass
+    elif level == 1:
+        # Quirk because the load screen detection works by
+        # checking for the score results screen, but when
+        # starting the first level, there is no results
+        # screen, of course. Instead we wait a fixed time.
+        ddonpach.send_wait_until('frames', 480)
+    else:
+        # Otherwise, it's assumed the game loaded inside a
+        # score screen that we wait to end.
+        ddonpach.send_action(get_action_str(vert=0, hori=0, shot=0))
+        ddonpach.read_gamestate()
+        ddonpach.send_wait_until('scoreScreen', False)
+
+    actions = [action for action, _ in fixed[start:]]
+    scores = [score for _, score in fixed[start:]]
+
+    if not actions:
+        score = fixed[-1][1] if fixed else 0
+        return score, False
+
+    trace, state = ddonpach.send_rollout(actions)
+    for expected, step in zip(scores, trace):
+        if expected != step[0]:
+            raise DdonpachSyncError('Score out of sync during replay.')
+
+    if state['scoreScreen']:
+        return scores[len(trace) - 1], True
+
+    if len(trace) < len(actions):
+        raise DdonpachSyncError('Ship died during replay.')
+
+    return scores[-1], False
+
+
+def get_plugins_dir():
+    """
+    Gets the plugins directory of the MAME home directory specified in the
+    global config.
+    """
+    return os.path.join(cfg.mame_path, 'plugins')
 
 
-def get_plugin_path():
+def get_plugin_path(plugins_dir=None):
     """
     Gets the target directory to save the dodonbotchi plugin to relevant to the
-    MAME home directory specified in the global config.
+    given plugins directory, defaulting to the one of the MAME home directory
+    specified in the global config.
     """
-    plugin_path = cfg.mame_path
-    plugin_path = os.path.join(plugin_path, 'plugins')
-    plugin_path = os.path.join(plugin_path, PLUGIN_NAME)
+    if not plugins_dir:
+        plugins_dir = get_plugins_dir()
+    plugin_path = os.path.join(plugins_dir, PLUGIN_NAME)
     return plugin_path
 
 
-def write_plugin(**options):
+def write_plugin(plugins_dir=None, **options):
     """
     Renders the templates for the code of the dodonbotchi plugin and writes it
-    to the appropriate plugin directory.
+    to the appropriate plugin directory. A custom plugins directory can be
+    given to keep renders for different options apart.
     """
-    plugin_path = get_plugin_path()
+    plugin_path = get_plugin_path(plugins_dir)
     ensure_directories(plugin_path)
 
     templates_path = os.path.join('dodonbotchi/plugin', PLUGIN_NAME)
@@ -129,32 +222,65 @@ def render_avi(inp_file, avi_file, inp_dir=None, snp_dir=None):
     return subprocess.call(call, shell=SHELL)
 
 
+def format_command(command, **options):
+    """
+    Returns the json message for a command with a `command` field and the
+    additional fields given in **options.
+    """
+    message = {'command': command}
+    for key, val in options.items():
+        message[key] = val
+    return json.dumps(message)
+
+
+def encode_message(message):
+    return '{}\n'.format(message).encode('utf-8')
+
+
+def rollout_steps(message):
+    return [(s, c, bool(d), f) for s, c, d, f in message['trace']]
+
+
 class Ddonpach:
 
-    def __init__(self, recording=None, seed=None, state=None):
+    def __init__(self, recording=None, seed=None, state=None, port=None,
+                 plugins_dir=None):
         self.inp_dir = None
         self.snp_dir = None
         self.sav_dir = None
+        self.plugins_dir = plugins_dir
 
         self.recording = recording
 
         self.process = None
         self.server = None
         self.client = None
-        self.sfile = None
+        self.stream = None
         self.waiting = True
 
+        self.payload = bytearray()
+        self.frame = None
+        self.last_state = None
+
         if not state:
             self.state = cfg.save_state
         else:
             self.state = state
 
+        if port is None:
+            port = cfg.port
+
+        # Port 0 makes the OS pick a free port, which is then baked into the
+        # plugin render for this session.
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind((cfg.host, cfg.port))
+        self.server.bind((cfg.host, port))
         self.server.listen()
-        log.info('Started socket server on %s:%s', cfg.host, cfg.port)
+        self.port = self.server.getsockname()[1]
+        log.info('Started socket server on %s:%s', cfg.host, self.port)
 
-        write_plugin(**cfg)
+        options = dict(cfg)
+        options['port'] = self.port
+        write_plugin(plugins_dir, **options)
 
     def send_message(self, message, force=False):
         """
@@ -163,8 +289,8 @@ class Ddonpach:
         if not force and not self.waiting:
             raise ValueError('Client is not waiting for new messages.')
 
-        self.sfile.write('{}\n'.format(message))
-        self.sfile.flush()
+        with metrics.timer('ddonpach.send'):
+            self.stream.write(encode_message(message))
         self.waiting = False
 
     def send_command(self, command, force=False, **options):
@@ -173,18 +299,115 @@ class Ddonpach:
         at least a `command` field and additional fields given in the
         **options.
         """
-        message = {'command': command}
-        for key, val in options.items():
-            message[key] = val
-        message = json.dumps(message)
+        message = format_command(command, **options)
         self.send_message(message, force=force)
 
     def send_action(self, action):
         """
         Sends an action to perform to the client. The given action must be a
-        member of the DoDonPachiActions space.
+        member of the DoDonPachiActions space. Macro actions are sent as a
+        hold command, which the client answers once after all their ticks.
+        """
+        inputs, hold = split_action(action)
+        if hold > 1:
+            self.send_command('hold', inputs=inputs, ticks=hold)
+        else:
+            self.send_command('action', inputs=inputs)
+
+    def send_rollout(self, actions, observe=None):
+        """
+        Has the client perform the given actions back-to-back without waiting
+        for a command between them. The rollout stops early when the ship dies
+        or the score screen appears. Returns a list of (score, combo, death,
+        frame) tuples, one per performed action, and the final game state.
+        Long action lists are sent in chunks of `ROLLOUT_CHUNK` actions.
+
+        If `observe` is given, it is called with the full game state after
+        every performed action, in order.
+        """
+        options = {'observe': True} if observe else {}
+
+        trace = []
+        state = None
+        for offset in range(0, max(len(actions), 1), ROLLOUT_CHUNK):
+            chunk = actions[offset:offset + ROLLOUT_CHUNK]
+            self.send_command('rollout', actions=list(chunk), **options)
+            state = None
+            while state is None:
+                message = self.read_message()
+                state = self.take_rollout_message(message, trace, observe)
+
+            if state['death'] or state['scoreScreen']:
+                break
+
+        return trace, state
+
+    def take_rollout_message(self, message, trace, observe):
+        """
+        Handles one message read while a rollout runs. Observed steps are
+        passed to `observe` and yield `None`, as more messages follow until
+        the rollout's reply. The reply's steps are appended to `trace` and its
+        final game state is returned.
+        """
+        if message['message'] == 'rolloutStep':
+            self.waiting = False
+            observe(message['state'])
+            return None
+
+        steps = rollout_steps(message)
+        trace.extend(steps)
+        state = message['state']
+        if observe and steps:
+            observe(state)
+        return state
+
+    def send_wait_until(self, condition, value=True, limit=0, address=None,
+                        width=1):
+        """
+        Lets the client emulate at full speed until the given condition holds
+        and returns the game state at that point. The condition is one of:
+
+        * `'frames'`: `value` frames have passed
+        * `'frame'`: the frame number reached `value`
+        * `'scoreScreen'`, `'death'`: the flag equals `value`
+        * `'memory'`: the unsigned `width` byte value at `address` equals
+          `value`
+
+        The client only reads what the condition needs each frame. With a
+        `limit`, the wait ends after that many frames regardless, so callers
+        should check the returned state if the condition might never hold.
+        """
+        options = {'condition': condition, 'value': value, 'limit': limit}
+        if address is not None:
+            options['address'] = address
+            options['width'] = width
+
+        self.send_command('waitUntil', **options)
+        return self.read_gamestate()
+
+    def send_wire_format(self, wire_format, delta=False, keyframe=0):
         """
-        self.send_command('action', inputs=action)
+        Tells the client which wire format to send game states in, either
+        `WIRE_JSON` for plain dictionaries or `WIRE_BINARY` for the packed
+        format described in `dodonbotchi.wire`. With `delta` set, the client
+        only sends changes to the previous state, with a full keyframe after
+        every `keyframe` deltas.
+        """
+        self.last_state = None
+        self.send_command('format', format=wire_format, delta=delta,
+                          keyframe=keyframe)
+        ack = self.read_message()
+        assert ack['message'] == 'ACK'
+
+    def send_frame_timing(self, enable):
+        """
+        Switches the client's frame timing on or off and returns the timings
+        it collected since the last call: the amount of frames, the total and
+        longest CPU time in seconds spent in the plugin's frame callback.
+        """
+        self.send_command('timing', enable=enable)
+        message = self.read_message()
+        return message['timing']
 
     def send_save_state(self, name):
         self.send_command('save', name=name)
@@ -200,48 +423,131 @@ class Ddonpach:
         """
         Reads a message from the client, expecting it to be in one line and a
         json object. The method returns the message parsed as a dictionary.
+        Game states sent in the binary wire format follow their message as a
+        payload and get decoded into the message's `state` field. Delta states
+        are applied to the last received state and the result is stored in
+        the `state` field as well.
         """
         if self.waiting:
             raise ValueError('Client is waiting for a message.')
 
-        line = self.sfile.readline()
-        self.waiting = True
-        return json.loads(line)
+        # Includes the time the client spends emulating until it replies.
+        with metrics.timer('ddonpach.recv'):
+            line = self.stream.readline()
+            self.waiting = True
+            message = json.loads(line)
+
+            payload = None
+            if message.get('format') == WIRE_BINARY:
+                payload = self.read_payload(message['size'])
+
+        with metrics.timer('ddonpach.decode'):
+            return self.decode_message(message, payload)
+
+    def decode_message(self, message, payload=None):
+        """
+        Fills in the `state` field of the given message from its binary
+        payload or json delta, if it has either, and remembers the state as
+        the base for following deltas.
+        """
+        if payload is not None:
+            if message.get('delta'):
+                state = decode_delta(payload, self.last_state)
+            else:
+                state = decode_state(payload)
+            message['state'] = state
+        elif 'delta' in message:
+            message['state'] = apply_delta(self.last_state, message['delta'])
+
+        if 'state' in message:
+            self.last_state = message['state']
+
+        return message
+
+    def read_payload(self, size):
+        """
+        Reads the given amount of raw bytes the client sent after a message
+        announcing them. The bytes are read into a buffer that is reused
+        between calls and returned as a memoryview of it.
+        """
+        view = self.payload_view(size)
+        read_exactly(self.stream, view)
+        return view
+
+    def payload_view(self, size):
+        if len(self.payload) < size:
+            self.payload = bytearray(size)
+
+        return memoryview(self.payload)[:size]
 
     def read_gamestate(self):
         message = self.read_message()
         state_dic = message['state']
         return state_dic
 
-    def get_snap(self):
-        self.send_command('snap')
-        ack = self.read_message()
-        assert ack['message'] == 'ACK'
+    def get_frame(self):
+        """
+        Fetches the current screen pixels straight from the client's memory
+        and returns them as an RGB array of shape (height, width, 3) in display
+        orientation. The array is reused and overwritten by the next call, so
+        callers have to copy it if they want to keep it.
+        """
+        with metrics.timer('ddonpach.frame'):
+            self.send_command('frame')
+            message = self.read_message()
+            raw = self.read_payload(message['size'])
+            return self.decode_frame(message, raw)
 
-        snap_dir = os.path.join(self.snp_dir, 'ddonpach')
-        snaps = list(sorted(os.listdir(snap_dir)))
-        snaps = [snap for snap in snaps if snap != 'current.png']
-        snap = snaps[-1]
-        snap = os.path.join(snap_dir, snap)
-        dest = os.path.join(snap_dir, 'current.png')
-        shutil.copy(snap, dest)
-        if os.path.exists(snap):
-            os.remove(snap)
-        ret = Image.open(dest)
-        return ret
+    def decode_frame(self, message, raw):
+        """
+        Converts the raw pixels announced by the given frame message into the
+        reused RGB frame array.
+        """
+        width, height = message['width'], message['height']
+        if len(raw) != width * height * 4:
+            raise ValueError('Frame size does not match its dimensions.')
 
-    def start_mame(self, avi=None):
+        # Pixels arrive as little-endian ARGB words, i.e. BGRA bytes.
+        argb = np.frombuffer(raw, dtype=np.uint8).reshape(height, width, 4)
+        rgb = np.rot90(argb[:, :, 2::-1], FRAME_ROTATION)
+
+        if self.frame is None or self.frame.shape != rgb.shape:
+            self.frame = np.empty(rgb.shape, dtype=np.uint8)
+        np.copyto(self.frame, rgb)
+        return self.frame
+
+    def get_snap(self):
         """
-        Boots up MAME with the globally configured options and additionally
-        setting it to record inputs this environment's respective folders for
-        those.
+        Returns the current screen contents as a PIL image.
+        """
+        return Image.fromarray(self.get_frame())
+
+    def build_call(self, avi=None):
+        """
+        Returns the command line starting MAME with the globally configured
+        options, the dodonbotchi plugin and this environment's directories.
         """
         ensure_directories(self.inp_dir, self.snp_dir)
 
+        if cfg.fake_mame:
+            # Only loaded when asked for, the real driver has no use for it.
+            from dodonbotchi.fakemame import fake_call
+            return fake_call(cfg.host, self.port, state=self.state,
+                             objects=cfg.fake_objects,
+                             tick_rate=cfg.tick_rate)
+
         call = generate_base_call(self.state)
         call.append('-plugin')
         call.append(PLUGIN_NAME)
 
+        if self.plugins_dir:
+            # The default plugins directory stays on the path since the
+            # dodonbotchi plugin relies on MAME's bundled json plugin.
+            abs_plugins_dir = os.path.abspath(self.plugins_dir)
+            plugins_path = '{};{}'.format(abs_plugins_dir, get_plugins_dir())
+            call.append('-pluginspath')
+            call.append(plugins_path)
+
         abs_inp_dir = os.path.abspath(self.inp_dir)
         call.append('-input_directory')
         call.append(abs_inp_dir)
@@ -262,13 +568,29 @@ class Ddonpach:
             call.append('-aviwrite')
             call.append(avi)
 
-        self.process = subprocess.Popen(call, shell=SHELL)
-        log.info('Started MAME with dodonbotchi ipc & dodonpachi.')
-        log.info('Waiting for MAME to connect...')
+        return call
 
-        self.client, addr = self.server.accept()
-        self.sfile = self.client.makefile(mode='rw')
-        log.info('Accepted client from: %s', addr)
+    def start_mame(self, avi=None):
+        """
+        Boots up MAME with the globally configured options and additionally
+        setting it to record inputs this environment's respective folders for
+        those.
+        """
+        with metrics.timer('ddonpach.start'):
+            call = self.build_call(avi)
+            self.process = subprocess.Popen(call, shell=SHELL)
+            log.info('Started MAME with dodonbotchi ipc & dodonpachi.')
+            log.info('Waiting for MAME to connect...')
+
+            self.client, addr = self.server.accept()
+            self.stream = SocketStream(self.client)
+            self.waiting = True
+            log.info('Accepted client from: %s', addr)
+
+            self.send_wire_format(cfg.wire_format, delta=cfg.delta_states,
+                                  keyframe=cfg.keyframe_interval)
+            if cfg.metrics:
+                self.send_frame_timing(True)
 
     def stop_mame(self):
         """
@@ -276,30 +598,39 @@ class Ddonpach:
         command, but killing the process manually if the client does not
         terminate on its own.
         """
-        if self.client and self.sfile:
-            self.send_command('kill', force=True)
+        with metrics.timer('ddonpach.stop'):
+            if self.client and self.stream:
+                try:
+                    self.send_command('kill', force=True)
+                except OSError:
+                    log.warning('Could not send kill command to MAME.')
 
-        sleep(1.5)
+                self.client.close()
 
-        for _ in range(10):
-            if not self.process:
-                break
+            sleep(1.5)
 
-            log.info('Waiting for MAME to die...')
-            try:
-                os.kill(self.process.pid, 0)
-            except OSError:
-                sleep(0.5)
-                continue
+            for _ in range(10):
+                if not self.process:
+                    break
 
-            self.process = None
+                log.info('Waiting for MAME to die...')
+                try:
+                    os.kill(self.process.pid, 0)
+                except OSError:
+                    sleep(0.5)
+                    continue
 
-        if self.process:
-            os.kill(self.process.pid, 9)
-            self.process = None
+                self.process = None
 
-        self.client = None
-        self.sfile = None
+            if self.process:
+                try:
+                    os.kill(self.process.pid, 9)
+                except ProcessLookupError:
+                    log.info('MAME already exited.')
+                self.process = None
+
+            self.client = None
+            self.stream = None
 
     def __enter__(self):
         self.start_mame()
@@ -321,4 +652,311 @@ class Ddonpach:
         self.process = None
         self.server = None
         self.client = None
-        self.sfile = None
+        self.stream = None
+
+
+class AsyncDdonpach(Ddonpach):
+    """
+    Variant of `Ddonpach` whose communication with MAME is done through
+    asyncio streams, so a single event loop can drive many instances and
+    overlap their waits on the emulator. Every method talking to MAME is a
+    coroutine here; setup and message decoding are shared with `Ddonpach`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.server.setblocking(False)
+
+        self.async_server = None
+        self.connected = None
+        self.reader = None
+        self.writer = None
+
+    def on_connect(self, reader, writer):
+        if self.connected and not self.connected.done():
+            self.connected.set_result((reader, writer))
+        else:
+            writer.close()
+
+    async def send_message(self, message, force=False):
+        """
+        Sends a message to the client, terminated by a newline.
+        """
+        if not force and not self.waiting:
+            raise ValueError('Client is not waiting for new messages.')
+
+        self.writer.write(encode_message(message))
+        self.waiting = False
+        await self.writer.drain()
+
+    async def send_command(self, command, force=False, **options):
+        message = format_command(command, **options)
+        await self.send_message(message, force=force)
+
+    async def send_action(self, action):
+        inputs, hold = split_action(action)
+        if hold > 1:
+            await self.send_command('hold', inputs=inputs, ticks=hold)
+        else:
+            await self.send_command('action', inputs=inputs)
+
+    async def send_rollout(self, actions, observe=None):
+        """
+        Coroutine version of `Ddonpach.send_rollout`.
+        """
+        options = {'observe': True} if observe else {}
+
+        trace = []
+        state = None
+        for offset in range(0, max(len(actions), 1), ROLLOUT_CHUNK):
+            chunk = actions[offset:offset + ROLLOUT_CHUNK]
+            await self.send_command('rollout', actions=list(chunk), **options)
+            state = None
+            while state is None:
+                message = await self.read_message()
+                state = self.take_rollout_message(message, trace, observe)
+
+            if state['death'] or state['scoreScreen']:
+                break
+
+        return trace, state
+
+    async def send_wait_until(self, condition, value=True, limit=0,
+                              address=None, width=1):
+        """
+        Coroutine version of `Ddonpach.send_wait_until`.
+        """
+        options = {'condition': condition, 'value': value, 'limit': limit}
+        if address is not None:
+            options['address'] = address
+            options['width'] = width
+
+        await self.send_command('waitUntil', **options)
+        return await self.read_gamestate()
+
+    async def send_wire_format(self, wire_format, delta=False, keyframe=0):
+        self.last_state = None
+        await self.send_command('format', format=wire_format, delta=delta,
+                                keyframe=keyframe)
+        ack = await self.read_message()
+        assert ack['message'] == 'ACK'
+
+    async def send_frame_timing(self, enable):
+        """
+        Coroutine version of `Ddonpach.send_frame_timing`.
+        """
+        await self.send_command('timing', enable=enable)
+        message = await self.read_message()
+        return message['timing']
+
+    async def send_save_state(self, name):
+        await self.send_command('save', name=name)
+        ack = await self.read_message()
+        assert ack['message'] == 'ACK'
+
+    async def send_load_state(self, name):
+        await self.send_command('load', name=name)
+        ack = await self.read_message()
+        assert ack['message'] == 'ACK'
+
+    async def read_message(self):
+        """
+        Coroutine version of `Ddonpach.read_message`.
+        """
+        if self.waiting:
+            raise ValueError('Client is waiting for a message.')
+
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError('Client closed connection.')
+        self.waiting = True
+        message = json.loads(line)
+
+        payload = None
+        if message.get('format') == WIRE_BINARY:
+            payload = await self.read_payload(message['size'])
+
+        return self.decode_message(message, payload)
+
+    async def read_payload(self, size):
+        view = self.payload_view(size)
+        view[:] = await self.reader.readexactly(size)
+        return view
+
+    async def read_gamestate(self):
+        message = await self.read_message()
+        return message['state']
+
+    async def get_frame(self):
+        """
+        Coroutine version of `Ddonpach.get_frame`.
+        """
+        await self.send_command('frame')
+        message = await self.read_message()
+        raw = await self.read_payload(message['size'])
+        return self.decode_frame(message, raw)
+
+    async def get_snap(self):
+        return Image.fromarray(await self.get_frame())
+
+    async def start_mame(self, avi=None):
+        """
+        Coroutine version of `Ddonpach.start_mame`.
+        """
+        loop = asyncio.get_running_loop()
+        if not self.async_server:
+            # Lines can hold whole rollout traces, well over the default
+            # limit of asyncio streams.
+            self.async_server = await asyncio.start_server(
+                self.on_connect, sock=self.server, limit=STREAM_LIMIT)
+
+        self.connected = loop.create_future()
+
+        call = self.build_call(avi)
+        self.process = await asyncio.create_subprocess_exec(*call)
+        log.info('Started MAME with dodonbotchi ipc & dodonpachi.')
+        log.info('Waiting for MAME to connect...')
+
+        self.reader, self.writer = await self.connected
+        self.waiting = True
+        addr = self.writer.get_extra_info('peername')
+        log.info('Accepted client from: %s', addr)
+
+        await self.send_wire_format(cfg.wire_format, delta=cfg.delta_states,
+                                    keyframe=cfg.keyframe_interval)
+        if cfg.metrics:
+            await self.send_frame_timing(True)
+
+    async def stop_mame(self):
+        """
+        Coroutine version of `Ddonpach.stop_mame`.
+        """
+        if self.writer:
+            try:
+                await self.send_command('kill', force=True)
+            except OSError:
+                log.warning('Could not send kill command to MAME.')
+
+            self.writer.close()
+
+        if self.process:
+            try:
+                await asyncio.wait_for(self.process.wait(), STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                log.info('Killing MAME that did not exit on its own.')
+                try:
+                    self.process.kill()
+                except ProcessLookupError:
+                    log.info('MAME already exited.')
+                await self.process.wait()
+
+        self.process = None
+        self.reader = None
+        self.writer = None
+
+    def __enter__(self):
+        raise TypeError('AsyncDdonpach is used with async with.')
+
+    async def __aenter__(self):
+        await self.start_mame()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop_mame()
+
+    async def close(self):
+        """
+        Kills MAME and closes the server socket.
+        """
+        if self.process:
+            await self.stop_mame()
+
+        if self.async_server:
+            self.async_server.close()
+            await self.async_server.wait_closed()
+        elif self.server:
+            self.server.close()
+
+        self.async_server = None
+        self.server = None
+
+
+class DdonpachPool:
+    """
+    Keeps a number of long-lived `Ddonpach` sessions around so callers do not
+    pay for a MAME boot and teardown every time they need an emulator. Users
+    are expected to reset a session they obtain by loading a savestate over
+    IPC. Sessions are created lazily by calling the given factory with the
+    index of the new session and only get restarted after an error occurred
+    while they were in use. The pool is safe to share between threads.
+    """
+
+    def __init__(self, factory, size=1):
+        self.factory = factory
+        self.size = size
+
+        self.sessions = []
+        self.free = queue.Queue()
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns a running session that is not used by anyone else, creating a
+        new one if the pool has not reached its size yet and blocking until
+        one is given back otherwise.
+        """
+        session = None
+        with self.lock:
+            if self.free.empty() and len(self.sessions) < self.size:
+                session = self.factory(len(self.sessions))
+                self.sessions.append(session)
+
+        if not session:
+            session = self.free.get()
+
+        if not session.process:
+            try:
+                session.start_mame()
+            except Exception:
+                # The slot goes back to the pool so its capacity is not lost.
+                self.put(session, broken=True)
+                raise
+
+        return session
+
+    def put(self, session, broken=False):
+        """
+        Gives a session back to the pool. Broken sessions are stopped and will
+        be restarted the next time they are handed out.
+        """
+        try:
+            if broken:
+                log.warning('Restarting broken MAME session.')
+                session.stop_mame()
+        finally:
+            self.free.put(session)
+
+    @contextmanager
+    def session(self):
+        """
+        Context manager handing out a session for the duration of the block,
+        marking it as broken if the block raises.
+        """
+        session = self.get()
+        try:
+            yield session
+        except Exception:
+            self.put(session, broken=True)
+            raise
+
+        self.put(session)
+
+    def close(self):
+        """
+        Closes every session created by this pool.
+        """
+        for session in self.sessions:
+            session.close()
+
+        self.sessions = []
+        self.free = queue.Queue()
@@ -0,0 +1,119 @@
+"""
+This module implements lightweight timers and counters for the phases of the
+evaluation loop. Like the configuration, a single instance lives in the field
+`METRICS` which other modules import as `from dodonbotchi.metrics import
+METRICS as metrics` and use like:
+
+    with metrics.timer('ddonpach.recv'):
+        ...
+
+While disabled, timers are a shared no-op context manager and counters return
+right away, so instrumented code pays next to nothing.
+"""
+import json
+import logging as log
+import threading
+import time
+
+from contextlib import contextmanager, nullcontext
+
+NULL_TIMER = nullcontext()
+
+
+class Metrics:
+    """
+    Thread-safe collection of named timings and counters. Timings keep their
+    count, total and maximum duration in seconds.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def add(self, name, seconds):
+        self.merge(name, 1, seconds, seconds)
+
+    def merge(self, name, count, total, longest):
+        """
+        Adds timings aggregated elsewhere, like in the plugin, to the timing
+        with the given name.
+        """
+        if not count:
+            return
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                self.timings[name] = [count, total, longest]
+                return
+            timing[0] += count
+            timing[1] += total
+            timing[2] = max(timing[2], longest)
+
+    @contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def timer(self, name):
+        """
+        Returns a context manager timing its body under the given name.
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return self.measure(name)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self, reset=False):
+        """
+        Returns the collected timings and counters as a dictionary, clearing
+        them if `reset` is set.
+        """
+        with self.lock:
+            timings = {}
+            for name, (count, total, longest) in self.timings.items():
+                timings[name] = {
+                    'count': count,
+                    'total': total,
+                    'mean': total / count,
+                    'max': longest,
+                }
+            snapshot = {'timings': timings, 'counters': dict(self.counters)}
+
+            if reset:
+                self.timings = {}
+                self.counters = {}
+
+        return snapshot
+
+    def emit(self, out_file=None, **context):
+        """
+        Logs the collected metrics as one json line, along with the given
+        context fields, and writes them to the given file if any. Collected
+        metrics are reset afterwards.
+        """
+        if not self.enabled:
+            return
+
+        snapshot = self.snapshot(reset=True)
+        snapshot.update(context)
+        log.info('Metrics: %s', json.dumps(snapshot, sort_keys=True))
+
+        if out_file:
+            with open(out_file, 'w') as out:
+                json.dump(snapshot, out, indent=4, sort_keys=True)
+
+
+METRICS = Metrics()
@@ -0,0 +1,181 @@
+"""
+This module implements encoding game states into fixed-shape NumPy arrays, so
+fitness shaping and learned policies do not have to walk the objects of a
+state in Python. An encoded observation holds:
+
+    ship     (batch, 4) position and size of the ship
+    scalars  (batch, len(SCALARS)) numeric fields of the state
+    objects  {class: (batch, limit, 4)} positions and sizes of the objects of
+             each class, padded with zeros up to the class's limit
+    masks    {class: (batch, limit)} which rows of `objects` are real objects
+    grid     (batch, 1 + len(OBJECT_CLASSES), rows, cols) amount of object
+             centers in each cell of a grid over the playfield, ship first
+
+Game states are accepted in either wire format, with objects as lists of
+dictionaries or as structured arrays of `OBJECT_DTYPE`. Encoders preallocate
+their arrays and overwrite them on every call, so callers have to copy what
+they want to keep.
+"""
+import numpy as np
+
+from dodonbotchi.wire import OBJECT_CLASSES
+
+PLAYFIELD_WIDTH = 320
+PLAYFIELD_HEIGHT = 240
+GRID_CELL = 8  # Pixels per side of a grid cell
+
+# Most objects of each class kept per state, the rest are dropped
+MAX_OBJECTS = {
+    'enemies': 64,
+    'bullets': 256,
+    'ownshot': 64,
+    'bonuses': 32,
+    'powerup': 8,
+}
+
+SCALARS = ('frame', 'death', 'lives', 'bombs', 'score', 'combo', 'hit',
+           'scoreScreen')
+OBJECT_FIELDS = ('pos_x', 'pos_y', 'siz_x', 'siz_y')
+
+
+def object_columns(objects):
+    """
+    Returns the given objects as a float32 array of shape (count, 4) holding
+    the fields in `OBJECT_FIELDS`.
+    """
+    if isinstance(objects, np.ndarray):
+        columns = np.empty((len(objects), len(OBJECT_FIELDS)), np.float32)
+        for idx, field in enumerate(OBJECT_FIELDS):
+            columns[:, idx] = objects[field]
+        return columns
+
+    if not objects:
+        return np.zeros((0, len(OBJECT_FIELDS)), np.float32)
+    rows = [[obj[field] for field in OBJECT_FIELDS] for obj in objects]
+    return np.array(rows, dtype=np.float32)
+
+
+class ObservationEncoder:
+    """
+    Encodes batches of up to `batch` game states at once into preallocated
+    arrays, growing them if a larger batch comes along.
+    """
+
+    def __init__(self, batch=1, max_objects=None, cell=GRID_CELL,
+                 width=PLAYFIELD_WIDTH, height=PLAYFIELD_HEIGHT):
+        self.max_objects = dict(MAX_OBJECTS)
+        if max_objects:
+            self.max_objects.update(max_objects)
+
+        self.cell = cell
+        self.width = width
+        self.height = height
+        self.cols = -(-width // cell)
+        self.rows = -(-height // cell)
+        self.channels = 1 + len(OBJECT_CLASSES)
+
+        self.allocate(batch)
+
+    def allocate(self, batch):
+        fields = len(OBJECT_FIELDS)
+
+        self.batch = batch
+        self.ship = np.zeros((batch, fields), np.float32)
+        self.scalars = np.zeros((batch, len(SCALARS)), np.float32)
+        self.objects = {}
+        self.masks = {}
+        for name in OBJECT_CLASSES:
+            limit = self.max_objects[name]
+            self.objects[name] = np.zeros((batch, limit, fields), np.float32)
+            self.masks[name] = np.zeros((batch, limit), bool)
+        self.grid = np.zeros((batch, self.channels, self.rows, self.cols),
+                             np.float32)
+
+    def grid_cells(self, columns):
+        """
+        Returns the flat grid cell index of each of the given objects' centers
+        and a mask of the objects whose centers lie on the playfield.
+        """
+        x = columns[:, 0] + columns[:, 2] / 2
+        y = columns[:, 1] + columns[:, 3] / 2
+        inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        cells = (y // self.cell).astype(np.intp) * self.cols
+        cells += (x // self.cell).astype(np.intp)
+        return cells, inside
+
+    def encode_batch(self, states):
+        """
+        Encodes the given sequence of game states and returns the observation
+        as a dictionary of arrays whose first axis indexes the states.
+        """
+        count = len(states)
+        if count > self.batch:
+            self.allocate(count)
+
+        ship = self.ship[:count]
+        scalars = self.scalars[:count]
+        ship[:] = 0
+        has_ship = np.zeros(count, bool)
+        for idx, state in enumerate(states):
+            if len(state['ship']):
+                ship[idx] = object_columns(state['ship'][:1])[0]
+                has_ship[idx] = True
+            scalars[idx] = [state[key] for key in SCALARS]
+
+        # Grid hits of every state and channel are collected first and counted
+        # in a single pass, with a channel's cells offset by the cells before.
+        plane = self.rows * self.cols
+        cells, inside = self.grid_cells(ship)
+        owners = np.arange(count)
+        flat = [(owners * self.channels * plane + cells)[inside & has_ship]]
+
+        for channel, name in enumerate(OBJECT_CLASSES, start=1):
+            objects = self.objects[name][:count]
+            masks = self.masks[name][:count]
+            objects[:] = 0
+            masks[:] = False
+
+            limit = self.max_objects[name]
+            per_state = []
+            for idx, state in enumerate(states):
+                columns = object_columns(state[name])[:limit]
+                objects[idx, :len(columns)] = columns
+                masks[idx, :len(columns)] = True
+                per_state.append(len(columns))
+
+            columns = objects[masks]
+            cells, inside = self.grid_cells(columns)
+            owners = np.repeat(np.arange(count), per_state)
+            offset = (owners * self.channels + channel) * plane
+            flat.append((offset + cells)[inside])
+
+        grid = self.grid[:count]
+        hits = np.bincount(np.concatenate(flat),
+                           minlength=count * self.channels * plane)
+        grid.reshape(-1)[:] = hits
+
+        return {
+            'ship': ship,
+            'scalars': scalars,
+            'objects': {name: self.objects[name][:count]
+                        for name in OBJECT_CLASSES},
+            'masks': {name: self.masks[name][:count]
+                      for name in OBJECT_CLASSES},
+            'grid': grid,
+        }
+
+    def encode(self, state):
+        """
+        Encodes a single game state, returning the observation without the
+        batch axis.
+        """
+        observation = self.encode_batch([state])
+        return {
+            'ship': observation['ship'][0],
+            'scalars': observation['scalars'][0],
+            'objects': {name: objects[0] for name, objects
+                        in observation['objects'].items()},
+            'masks': {name: masks[0] for name, masks
+                      in observation['masks'].items()},
+            'grid': observation['grid'][0],
+        }
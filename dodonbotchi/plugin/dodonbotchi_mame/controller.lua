@@ -123,6 +123,16 @@ function performButton(state, key)
   end
 end
 
+function splitAction(action)
+  -- Macro actions name the amount of ticks their inputs are held for after
+  -- a colon, as in '1210:4'. Plain actions are held for a single tick.
+  local inputs, ticks = action:match('^(%d+):(%d+)$')
+  if inputs == nil then
+    return action, 1
+  end
+  return inputs, tonumber(ticks)
+end
+
 function performAction(action)
   local vertical = action:sub(1, 1)
   performDirection(vertical, 'U', 'D')
@@ -196,5 +206,6 @@ exports.stopHold = stopHold
 exports.singlePress = singlePress
 exports.render = render
 exports.performAction = performAction
+exports.splitAction = splitAction
 
 return exports
@@ -47,7 +47,7 @@ function displayBotchi()
   end
   
   if renderSprites then
-    sprt.readSprites(mem, 0)
+    sprt.readSprites(mem, 0, screen:frame_number())
     sprt.render(screen)
   end
   
@@ -1,11 +1,18 @@
 local json = require('json')
 
+local READ_SIZE = 4096
+
 local socket = nil
+local buffer = ''
 
 function sendMessage(message)
   socket:write(message .. '\n')
 end
 
+function sendBytes(data)
+  socket:write(data)
+end
+
 function sendACK()
   local message = {message = 'ACK'}
   message = json.stringify(message)
@@ -13,13 +20,29 @@ function sendACK()
 end
 
 function readMessage()
-  local message = socket:read(4096)
-  if message ~= nil and #message > 0 then
-    message = json.parse(message)
-    return message
+  -- Messages are newline-terminated, but a read may return part of one or
+  -- several at once, so data is buffered until a full line is available.
+  local eol = string.find(buffer, '\n', 1, true)
+  if eol == nil then
+    local chunks = {buffer}
+    repeat
+      local data = socket:read(READ_SIZE)
+      if data == nil or #data == 0 then
+        break
+      end
+      table.insert(chunks, data)
+    until string.find(data, '\n', 1, true)
+    buffer = table.concat(chunks)
+    eol = string.find(buffer, '\n', 1, true)
   end
-  
-  return nil
+
+  if eol == nil then
+    return nil
+  end
+
+  local line = string.sub(buffer, 1, eol - 1)
+  buffer = string.sub(buffer, eol + 1)
+  return json.parse(line)
 end
 
 function init()
@@ -30,6 +53,7 @@ end
 exports = {}
 
 exports.sendMessage = sendMessage
+exports.sendBytes = sendBytes
 exports.sendACK = sendACK
 
 exports.readMessage = readMessage
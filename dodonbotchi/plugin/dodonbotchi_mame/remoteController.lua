@@ -9,28 +9,241 @@ local screen = nil
 local tickRate = {{tick_rate}}
 local sleepFrames = 15
 
+local wireFormat = 'json'
+local deltaStates = false
+local keyframeInterval = 0
+local sinceKeyframe = 0
+local lastSent = nil
+
 local cooldown = 0
-local waitScore = false
+local waiting = nil
+local rollout = nil
+local holding = nil
+
+local timing = false
+local timedFrames = 0
+local timedTotal = 0
+local timedMax = 0
+
+function sendStateMessage(message, currentState)
+  -- In delta mode, only changes relative to the last sent state go out,
+  -- except for a full keyframe every keyframeInterval states.
+  local delta = nil
+  if deltaStates and lastSent ~= nil and sinceKeyframe < keyframeInterval then
+    delta = state.diffGameState(lastSent, currentState)
+    sinceKeyframe = sinceKeyframe + 1
+  else
+    sinceKeyframe = 0
+  end
+  lastSent = currentState
+
+  -- In the binary wire format, the packed state follows the message as a
+  -- payload of the announced size instead of being part of the json.
+  if wireFormat == 'binary' then
+    local payload = nil
+    if delta ~= nil then
+      payload = state.packDelta(currentState, delta)
+      message.delta = true
+    else
+      payload = state.packGameState(currentState)
+    end
+    message.format = 'binary'
+    message.size = #payload
+    ipc.sendMessage(json.stringify(message))
+    ipc.sendBytes(payload)
+  else
+    if delta ~= nil then
+      message.delta = delta
+    else
+      message.state = currentState
+    end
+    ipc.sendMessage(json.stringify(message))
+  end
+end
 
 function produceSocketOutput()
   local currentState = state.readGameState()
-  local message = {message = 'gamestate', state = currentState}
+  local message = {message = 'gamestate'}
+  sendStateMessage(message, currentState)
+end
+
+function produceFrameOutput()
+  -- Sends the raw ARGB32 screen pixels right after a message announcing
+  -- their dimensions and size, sparing both sides a PNG round trip on disk.
+  local pixels, width, height = screen:pixels()
+  if width == nil then
+    width = screen:width()
+    height = screen:height()
+  end
+
+  local message = {message = 'frame', width = width, height = height, size = #pixels}
   message = json.stringify(message)
 
   ipc.sendMessage(message)
+  ipc.sendBytes(pixels)
+end
+
+function produceRolloutOutput()
+  local currentState = state.readGameState()
+  local message = {message = 'rollout', trace = rollout.trace}
+  sendStateMessage(message, currentState)
+end
+
+function performRolloutAction(action)
+  local inputs, ticks = ctrl.splitAction(action)
+  rollout.inputs = inputs
+  rollout.remaining = ticks - 1
+  ctrl.performAction(inputs)
+end
+
+function startRollout(actions, observe)
+  rollout = {actions = actions, index = 1, trace = {}, observe = observe}
+
+  if #actions == 0 then
+    produceRolloutOutput()
+    rollout = nil
+    return
+  end
+
+  performRolloutAction(actions[1])
+  emu.unpause()
+  sleepFrames = tickRate
+end
+
+function stepRollout()
+  -- Records a compact trace entry for the action that just finished and
+  -- either performs the next one right away or ends the rollout, replying
+  -- with the trace and the full final state.
+  local progress = state.readProgress()
+
+  -- Macro actions perform their inputs afresh every tick until they ran
+  -- for all their ticks, like as many repeated actions would, unless the
+  -- ship dies or the level ends first.
+  if rollout.remaining > 0 and not progress.death and not progress.scoreScreen then
+    rollout.remaining = rollout.remaining - 1
+    state.trackXOffset()
+    ctrl.performAction(rollout.inputs)
+    sleepFrames = tickRate
+    tick()
+    return
+  end
+
+  local death = 0
+  if progress.death then
+    death = 1
+  end
+  table.insert(rollout.trace, {progress.score, progress.combo, death, progress.frame})
+
+  local index = rollout.index + 1
+  if progress.death or progress.scoreScreen or index > #rollout.actions then
+    produceRolloutOutput()
+    rollout = nil
+    emu.pause()
+    return
+  end
+
+  -- Observed rollouts also stream the full state after every action but the
+  -- last, whose state comes with the reply anyway.
+  if rollout.observe then
+    sendStateMessage({message = 'rolloutStep'}, state.readGameState())
+  else
+    state.trackXOffset()
+  end
+
+  rollout.index = index
+  performRolloutAction(rollout.actions[index])
+  sleepFrames = tickRate
+  tick()
+end
+
+function resumeHeldAction()
+  ctrl.performAction(holding.inputs)
+  emu.unpause()
+  sleepFrames = tickRate
+end
+
+function startHeldAction(inputs, ticks)
+  holding = {inputs = inputs, remaining = ticks - 1}
+  resumeHeldAction()
+end
+
+function stepHeldAction()
+  -- Between ticks, the machine pauses for a frame and the inputs are
+  -- performed afresh, exactly like separate action commands would. The
+  -- reply goes out after the last tick or as soon as the ship dies or the
+  -- level ends.
+  local progress = state.readProgress()
+  if holding.remaining > 0 and not progress.death and not progress.scoreScreen then
+    holding.remaining = holding.remaining - 1
+    state.trackXOffset()
+    emu.pause()
+    return
+  end
+
+  holding = nil
+  produceSocketOutput()
+  emu.pause()
+end
+
+function startWait(predicate)
+  predicate.elapsed = 0
+  predicate.limit = tonumber(predicate.limit or 0)
+  waiting = predicate
+  -- Drops whatever reply a load or save cooldown left pending, checkWait
+  -- schedules the reply once the predicate holds.
+  sleepFrames = 0
+  emu.unpause()
+end
+
+function checkWait()
+  -- Once the predicate holds or the frame limit is hit, the next tick
+  -- replies with the full state, just like after a regular action.
+  waiting.elapsed = waiting.elapsed + 1
+
+  local done = false
+  if waiting.condition == 'frames' then
+    done = waiting.elapsed >= waiting.value
+  elseif waiting.condition == 'frame' then
+    done = state.readCondition('frame') >= waiting.value
+  else
+    local value = state.readCondition(waiting.condition, waiting.address, waiting.width)
+    done = value == waiting.value
+  end
+
+  if done or (waiting.limit > 0 and waiting.elapsed >= waiting.limit) then
+    waiting = nil
+    sleepFrames = 1
+  end
+end
+
+function tick()
+  sleepFrames = sleepFrames - 1
+  ctrl.updateInputStates()
+  if sleepFrames == 0 then
+    if rollout ~= nil then
+      stepRollout()
+    elseif holding ~= nil then
+      stepHeldAction()
+    else
+      produceSocketOutput()
+      emu.pause()
+    end
+  end
 end
 
 function handleSocketInput()
   local message = ipc.readMessage()
   if message ~= nil then
     if message['command'] == 'wait' then
-      emu.unpause()
-      cooldown = tonumber(message['frames'])
+      startWait({condition = 'frames', value = tonumber(message['frames'])})
     end
 
     if message['command'] == 'waitScore' then
-      emu.unpause()
-      waitScore = true
+      startWait({condition = 'scoreScreen', value = false})
+    end
+
+    if message['command'] == 'waitUntil' then
+      startWait(message)
     end
 
     if message['command'] == 'kill' then
@@ -43,11 +256,40 @@ function handleSocketInput()
       sleepFrames = tickRate
     end
 
+    if message['command'] == 'hold' then
+      startHeldAction(message['inputs'], tonumber(message['ticks']))
+    end
+
+    if message['command'] == 'rollout' then
+      startRollout(message['actions'], message['observe'])
+    end
+
     if message['command'] == 'snap' then
       screen:snapshot()
       ipc.sendACK()
     end
 
+    if message['command'] == 'format' then
+      wireFormat = message['format']
+      deltaStates = message['delta']
+      keyframeInterval = tonumber(message['keyframe'])
+      lastSent = nil
+      ipc.sendACK()
+    end
+
+    if message['command'] == 'timing' then
+      local report = {frames = timedFrames, total = timedTotal, max = timedMax}
+      timing = message['enable']
+      timedFrames = 0
+      timedTotal = 0
+      timedMax = 0
+      ipc.sendMessage(json.stringify({message = 'timing', timing = report}))
+    end
+
+    if message['command'] == 'frame' then
+      produceFrameOutput()
+    end
+
     if message['command'] == 'save' then
       local name = message['name']
       manager:machine():save(name)
@@ -59,6 +301,8 @@ function handleSocketInput()
     if message['command'] == 'load' then
       local name = message['name']
       manager:machine():load(name)
+      state.reset()
+      lastSent = nil
       emu.pause()
       ctrl.performAction('0000')
       ipc.sendACK()
@@ -67,7 +311,7 @@ function handleSocketInput()
   end
 end
 
-function update()
+function updateFrame()
   if cooldown > 0 then
     cooldown = cooldown - 1
     if cooldown <= 0 then
@@ -76,28 +320,41 @@ function update()
     return
   end
 
-  if waitScore then
-    local currentState = state.readGameState()
-    if not currentState.scoreScreen then
-      waitScore = false
-      sleepFrames = 1
-    end
+  if waiting ~= nil then
+    checkWait()
     return
   end
 
   if manager:machine().paused then
-    handleSocketInput()
-  end
-
-  if not manager:machine().paused then
-    sleepFrames = sleepFrames - 1
-    ctrl.updateInputStates()
-    if sleepFrames == 0 then
-      produceSocketOutput()
-      emu.pause()
+    if holding ~= nil then
+      resumeHeldAction()
     else
+      handleSocketInput()
     end
   end
+
+  -- A wait that just started replies through checkWait alone, so it must
+  -- not tick off a reply still pending from a load or save.
+  if waiting == nil and not manager:machine().paused then
+    tick()
+  end
+end
+
+function update()
+  if not timing then
+    updateFrame()
+    return
+  end
+
+  local began = os.clock()
+  updateFrame()
+  local took = os.clock() - began
+
+  timedFrames = timedFrames + 1
+  timedTotal = timedTotal + took
+  if took > timedMax then
+    timedMax = took
+  end
 end
 
 function update_post()
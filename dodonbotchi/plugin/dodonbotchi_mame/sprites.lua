@@ -5,7 +5,12 @@ local layer1End = 0x404000 - 0x10
 local layer2Start = 0x404000
 local layer2End = 0x408000 - 0x10
 
+-- sid, x, y and mode of a sprite entry, big-endian like the 68000's memory
+local SPRITE_FIELDS = '>I4I2I2I2'
+local SPRITE_SIZE = 0x10
+
 local sprites = {}
+local cache = {}
 local spriteColours = {
   0xFFFF0000,
   0xFF00FF00,
@@ -39,12 +44,20 @@ function readSpriteAt(mem, i)
   end
 end
 
-function readSprites(mem, layer)
+function readSprites(mem, layer, frame)
+  -- Reads every sprite of the given layer. When a frame number is given, the
+  -- result is cached and reused for later calls within the same frame.
   if layer == nil then
     layer = 0
   end
   
-  local spriteStart, spriteEnd, sid, sid1, sid2, pos, x, y, mode, width, height, data
+  local cached = cache[layer]
+  if frame ~= nil and cached ~= nil and cached.frame == frame then
+    sprites = cached.sprites
+    return sprites
+  end
+  
+  local spriteStart, spriteEnd
   
   if layer == 1 then
     spriteStart = layer1Start
@@ -54,18 +67,34 @@ function readSprites(mem, layer)
     spriteEnd = layer2End
   end
   
+  -- The whole layer is fetched in one read and decoded in place.
+  local block = mem:read_range(spriteStart, spriteEnd + SPRITE_SIZE - 1, 8)
+  
   sprites = {}
-  for i = spriteStart, spriteEnd, 0x10 do
-    local data = readSpriteAt(mem, i)
+  for i = spriteStart, spriteEnd, SPRITE_SIZE do
+    local sid, pos_x, pos_y, mode = string.unpack(SPRITE_FIELDS, block, i - spriteStart + 1)
     
-    if data ~= nil then
-      table.insert(sprites, data)
+    if sid > 0 then
+      table.insert(sprites, {sid = sid,
+        pos_x = pos_x,
+        pos_y = pos_y,
+        siz_x = 16 * math.floor(mode / 256),
+        siz_y = 16 * (mode % 256),
+      mode = mode})
     end
   end
   
+  if frame ~= nil then
+    cache[layer] = {frame = frame, sprites = sprites}
+  end
+  
   return sprites
 end
 
+function reset()
+  cache = {}
+end
+
 function getSprites()
   return sprites
 end
@@ -90,6 +119,7 @@ end
 exports.readSpriteAt = readSpriteAt
 exports.readSprites = readSprites
 exports.getSprites = getSprites
+exports.reset = reset
 exports.render = render
 
 return exports
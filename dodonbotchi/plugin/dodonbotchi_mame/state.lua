@@ -47,10 +47,24 @@ local HIT = 0x1017EA
 
 local SCORE_SCREEN = 0x1017A4
 
+-- id, sid, x, y and mode of an object, big-endian like the 68000's memory
+local OBJECT_FIELDS = '>I2I4I2I2I2'
+local OBJECT_FIELDS_SIZE = 12
+
+-- Binary wire format layouts, kept in sync with dodonbotchi/wire.py
+local HEADER_FORMAT = '<i2I4BBBI4BI2Bi2i2I2I2I2I2I2'
+local OBJECT_FORMAT = '<I2I2I4i2i2I2I2I2'
+local SLOT_FORMAT = '<I2'
+
+local SCALARS = {'x_off', 'frame', 'death', 'lives', 'bombs', 'score', 'combo', 'hit', 'scoreScreen'}
+local OBJECT_CLASSES = {'enemies', 'bullets', 'ownshot', 'bonuses', 'powerup'}
+local OBJECT_KEYS = {'id', 'sid', 'pos_x', 'pos_y', 'siz_x', 'siz_y', 'mode'}
+
 local mem = nil
 local screen = nil
 
 local lastState = nil
+local lastFrame = nil
 
 local screenMaxX = 320
 local screenMaxY = 240
@@ -68,21 +82,23 @@ local function readObjects(ret, xDelta, addr, addr_end, step, null)
     null = false
   end
   
+  -- The whole range is fetched in one read and decoded in place, which is a
+  -- lot cheaper than several reads through the memory space per object.
+  local block = mem:read_range(addr, addr_end + OBJECT_FIELDS_SIZE - 1, 8)
+  
   for i = addr, addr_end, step do
-    local id = mem:read_u16(i + 0)
+    local slot = (i - addr) // step
+    local id, sid, pos_x, pos_y, mode = string.unpack(OBJECT_FIELDS, block, i - addr + 1)
     if null or id ~= 0 then
-      local sid = mem:read_u32(i + 2)
-      local pos_x = mem:read_u16(i + 6)
-      local pos_y = mem:read_u16(i + 8)
       pos_x = math.floor(pos_x / 64)
       pos_y = math.floor(pos_y / 64)
       pos_y = pos_y - xDelta
       if pos_x < screenMaxX and pos_y < screenMaxY then
-        local mode = mem:read_u16(i + 10)
         local siz_x = 16 * math.floor(mode / 256)
         local siz_y = 16 * (mode % 256)
         
-        local obj = {id = id,
+        local obj = {slot = slot,
+          id = id,
           sid = sid,
           pos_x = pos_x,
           pos_y = pos_y,
@@ -173,12 +189,61 @@ local function readScoreScreen()
   return scoreScreen == 0x300
 end
 
+local function readProgress()
+  return {
+    frame = screen:frame_number(),
+    score = readScore(),
+    combo = readCombo(),
+    death = readDeath(),
+    scoreScreen = readScoreScreen()
+  }
+end
+
+local function trackXOffset()
+  -- Objects are corrected by how far the playfield scrolled since the last
+  -- state was read. Steps that go by without reading their full state, like
+  -- the ones of rollouts, still move the reference on, so the next state is
+  -- corrected by the scrolling of its own step only.
+  xOffSet = math.floor(mem:read_i16(X_OFFSET) / 64)
+end
+
+local function readMemory(address, width)
+  if width == 4 then
+    return mem:read_u32(address)
+  elseif width == 2 then
+    return mem:read_u16(address)
+  end
+  return mem:read_u8(address)
+end
+
+local function readCondition(condition, address, width)
+  -- Reads only what the given wait condition depends on, which is a lot
+  -- cheaper than building the full game state every frame.
+  if condition == 'scoreScreen' then
+    return readScoreScreen()
+  elseif condition == 'death' then
+    return readDeath()
+  elseif condition == 'frame' then
+    return screen:frame_number()
+  elseif condition == 'memory' then
+    return readMemory(address, width)
+  end
+  return nil
+end
+
 local function readGameState()
+  local frame = screen:frame_number()
+  if lastState ~= nil and lastFrame == frame then
+    -- Memory does not change within a frame, so repeated reads in the same
+    -- frame can reuse the last state.
+    return lastState
+  end
+  
   local currentXOffset = math.floor(mem:read_i16(X_OFFSET) / 64)
   local xDelta = xOffSet - currentXOffset
   
-  local layer1 = sprt.readSprites(mem, 0)
-  local layer2 = sprt.readSprites(mem, 1)
+  local layer1 = sprt.readSprites(mem, 0, frame)
+  local layer2 = sprt.readSprites(mem, 1, frame)
   local visible = {}
   for i = 1, #layer1 do
     local sid = layer1[i].sid
@@ -189,8 +254,6 @@ local function readGameState()
     visible[sid] = true
   end
   
-  local frame = screen:frame_number()
-  
   local ship = {readShip()}
   
   local enemies = {}
@@ -239,11 +302,134 @@ local function readGameState()
   }
   
   lastState = state
+  lastFrame = frame
   xOffSet = currentXOffset
   
   return state
 end
 
+local function flag(value)
+  if value then
+    return 1
+  end
+  return 0
+end
+
+local function packObjects(parts, objects)
+  for i = 1, #objects do
+    local obj = objects[i]
+    parts[#parts + 1] = string.pack(OBJECT_FORMAT, obj.slot, obj.id, obj.sid, obj.pos_x, obj.pos_y, obj.siz_x, obj.siz_y, obj.mode)
+  end
+end
+
+local function packHeader(state, objects)
+  local ship = state.ship[1]
+  return string.pack(HEADER_FORMAT,
+    state.x_off, state.frame, flag(state.death), state.lives, state.bombs,
+    state.score, state.combo, state.hit, flag(state.scoreScreen),
+    ship.pos_x, ship.pos_y,
+    #objects.enemies, #objects.bullets, #objects.ownshot, #objects.bonuses, #objects.powerup)
+end
+
+local function packGameState(state)
+  local parts = {packHeader(state, state)}
+  
+  for i = 1, #OBJECT_CLASSES do
+    packObjects(parts, state[OBJECT_CLASSES[i]])
+  end
+  
+  return table.concat(parts)
+end
+
+local function sameObject(a, b)
+  for i = 1, #OBJECT_KEYS do
+    local key = OBJECT_KEYS[i]
+    if a[key] ~= b[key] then
+      return false
+    end
+  end
+  return true
+end
+
+local function diffObjects(last, current)
+  local bySlot = {}
+  for i = 1, #last do
+    bySlot[last[i].slot] = last[i]
+  end
+  
+  local upsert = {}
+  for i = 1, #current do
+    local obj = current[i]
+    local old = bySlot[obj.slot]
+    if old == nil or not sameObject(old, obj) then
+      table.insert(upsert, obj)
+    end
+    bySlot[obj.slot] = nil
+  end
+  
+  local remove = {}
+  for slot, _ in pairs(bySlot) do
+    table.insert(remove, slot)
+  end
+  
+  return upsert, remove
+end
+
+local function diffGameState(last, current)
+  -- Determines what changed between two states: the scalars that differ,
+  -- objects that appeared in or changed their slot, and slots that emptied.
+  local scalars = {}
+  for i = 1, #SCALARS do
+    local key = SCALARS[i]
+    if last[key] ~= current[key] then
+      scalars[key] = current[key]
+    end
+  end
+  
+  local lastShip = last.ship[1]
+  local ship = current.ship[1]
+  if lastShip.pos_x ~= ship.pos_x or lastShip.pos_y ~= ship.pos_y then
+    scalars.ship = current.ship
+  end
+  
+  local upsert = {}
+  local remove = {}
+  for i = 1, #OBJECT_CLASSES do
+    local name = OBJECT_CLASSES[i]
+    upsert[name], remove[name] = diffObjects(last[name], current[name])
+  end
+  
+  return {scalars = scalars, upsert = upsert, remove = remove}
+end
+
+local function packDelta(state, delta)
+  -- Scalars are cheap enough in binary to always be sent in full, so a
+  -- packed delta only differs from a full state in its object records,
+  -- followed by the emptied slots of each object class.
+  local parts = {packHeader(state, delta.upsert)}
+  
+  for i = 1, #OBJECT_CLASSES do
+    packObjects(parts, delta.upsert[OBJECT_CLASSES[i]])
+  end
+  
+  for i = 1, #OBJECT_CLASSES do
+    local slots = delta.remove[OBJECT_CLASSES[i]]
+    parts[#parts + 1] = string.pack(SLOT_FORMAT, #slots)
+    for j = 1, #slots do
+      parts[#parts + 1] = string.pack(SLOT_FORMAT, slots[j])
+    end
+  end
+  
+  return table.concat(parts)
+end
+
+local function reset()
+  lastState = nil
+  lastFrame = nil
+  xOffSet = 0
+  sprt.reset()
+end
+
 local function init(sprite)
   mem = manager:machine().devices[':maincpu'].spaces['program']
   screen = manager:machine().screens[':screen']
@@ -297,7 +483,14 @@ local function render(state)
 end
 
 exports.init = init
+exports.reset = reset
 exports.readGameState = readGameState
+exports.readProgress = readProgress
+exports.trackXOffset = trackXOffset
+exports.readCondition = readCondition
+exports.packGameState = packGameState
+exports.diffGameState = diffGameState
+exports.packDelta = packDelta
 exports.render = render
 
 return exports
@@ -0,0 +1,431 @@
+"""
+This module distributes candidate evaluations over worker processes, possibly
+on other machines. A worker runs a pool of `Ddonpach` sessions and serves
+evaluation requests from a coordinator over TCP, one connection per session.
+
+A request names the savestate to start from and the fixed (action, score)
+pairs to replay after it by the sha256 of their contents. Workers ask the
+coordinator for contents they have not seen yet and keep them on disk, so
+every savestate and fixed prefix crosses the network once per worker. Workers
+also save the state reached after replaying a fixed prefix, which makes every
+evaluation after the first one in a window start right at the candidate. Only
+the states of the most recently used prefixes are kept.
+
+Messages are json objects terminated by a newline, like the ones exchanged
+with the MAME plugin. Blob contents follow their message as a payload.
+"""
+import hashlib
+import json
+import logging as log
+import os
+import queue
+import socket
+import socketserver
+import threading
+
+from collections import OrderedDict
+from pathlib import Path
+
+from dodonbotchi.danger import DangerIndex
+from dodonbotchi.ipc import SocketStream, read_exactly
+from dodonbotchi.mame import Ddonpach, DdonpachPool, DdonpachSyncError
+from dodonbotchi.mame import encode_message, replay_fixed
+from dodonbotchi.util import ensure_directories
+
+WORKER_PORT = 32768
+MAX_BLOBS = 32  # Blobs the coordinator keeps around for workers to fetch
+MAX_PREFIXES = 16  # Prefix savestates a worker keeps around
+
+
+def content_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def send(stream, message, payload=None):
+    stream.write(encode_message(json.dumps(message)))
+    if payload is not None:
+        stream.write(payload)
+
+
+def receive(stream):
+    """
+    Reads the next message from the given stream, along with its payload if
+    the message announces one.
+    """
+    line = stream.readline()
+    message = json.loads(line)
+
+    payload = None
+    if 'size' in message:
+        payload = bytearray(message['size'])
+        read_exactly(stream, memoryview(payload))
+
+    return message, payload
+
+
+class Worker:
+    """
+    Evaluates candidates on a pool of local emulator instances for remote
+    coordinators. Blobs and prefix savestates are kept in the given working
+    directory, the latter only for the `max_prefixes` most recently used
+    prefixes.
+    """
+
+    def __init__(self, cwd, instances=1, max_prefixes=MAX_PREFIXES):
+        cwd = Path(cwd)
+        self.ins = cwd / 'ins'
+        self.blobs = cwd / 'blobs'
+        self.prefixes = cwd / 'prefixes'
+        ensure_directories(str(self.blobs), str(self.prefixes))
+
+        # Starting scores are not kept across runs, so neither are the states.
+        for stale in self.prefixes.iterdir():
+            stale.unlink()
+
+        self.instances = instances
+        self.pool = DdonpachPool(self.open_instance, size=instances)
+
+        self.max_prefixes = max_prefixes
+        self.lock = threading.Lock()
+        self.starting_scores = OrderedDict()
+
+    def open_instance(self, idx):
+        ins = self.ins / '{:03}'.format(idx)
+        ddonpach = Ddonpach(port=0, plugins_dir=str(ins / 'plg'))
+        ddonpach.inp_dir = str(ins / 'inp')
+        ddonpach.snp_dir = str(ins / 'snp')
+        ddonpach.sav_dir = str(ins / 'sav')
+        return ddonpach
+
+    def blob_path(self, key):
+        return str((self.blobs / key).resolve())
+
+    def fetch(self, stream, key):
+        """
+        Returns the local path of the blob with the given key, requesting it
+        from the coordinator on the other end of the stream if it is missing.
+        """
+        path = self.blob_path(key)
+        if os.path.exists(path):
+            return path
+
+        send(stream, {'message': 'need', 'key': key})
+        message, payload = receive(stream)
+        if content_key(payload) != message['key'].split('.')[0]:
+            raise ValueError('Received corrupted blob: {}'.format(key))
+
+        # Written under a temporary name first, since connections served by
+        # other threads might be looking for the same blob.
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as out_file:
+            out_file.write(payload)
+        os.replace(tmp_path, path)
+
+        log.info('Fetched blob: %s', key)
+        return path
+
+    def prefix_path(self, key):
+        return str((self.prefixes / '{}.sta'.format(key)).resolve())
+
+    def remember_prefix(self, key, saved, starting_score):
+        """
+        Moves the savestate of the prefix with the given key into place from
+        the temporary path it was saved to and records its starting score,
+        dropping the least recently used prefixes beyond `max_prefixes`.
+        """
+        os.replace(saved, self.prefix_path(key))
+        with self.lock:
+            self.starting_scores[key] = starting_score
+            self.starting_scores.move_to_end(key)
+            while len(self.starting_scores) > self.max_prefixes:
+                evicted, _ = self.starting_scores.popitem(last=False)
+                path = self.prefix_path(evicted)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def prepare(self, stream, ddonpach, request):
+        """
+        Brings the given session to the end of the fixed prefix named in the
+        request and returns the score there, replaying the prefix only the
+        first time it is seen. Also returns the key of a prefix that was
+        replayed and the temporary path of its savestate, or None.
+
+        MAME only writes a savestate once the frame it was requested in is
+        done, after acknowledging it. Other sessions might replay the same
+        prefix at the same time, so the state is saved under a name of this
+        thread's own and only moved into place by `remember_prefix` once the
+        session answered a later command.
+        """
+        state, prefix = request['state'], request['prefix']
+        key = content_key('{}:{}'.format(state, prefix).encode('utf-8'))
+        prefix_state = self.prefix_path(key)
+
+        with self.lock:
+            starting_score = self.starting_scores.get(key)
+            if starting_score is not None:
+                self.starting_scores.move_to_end(key)
+        if starting_score is not None and os.path.exists(prefix_state):
+            ddonpach.send_load_state(prefix_state)
+            return starting_score, None
+
+        ddonpach.send_load_state(self.fetch(stream, state))
+        with open(self.fetch(stream, prefix), 'r') as in_file:
+            fixed = [tuple(pair) for pair in json.load(in_file)]
+
+        start = request['start']
+        starting_score, _ = replay_fixed(ddonpach, request['level'], fixed,
+                                         start)
+        saved = '{}.{}.tmp'.format(prefix_state, threading.get_ident())
+        ddonpach.send_save_state(saved)
+        return starting_score, (key, saved)
+
+    def evaluate(self, stream, request):
+        pending = None
+        try:
+            with self.pool.session() as ddonpach:
+                starting_score, pending = self.prepare(stream, ddonpach,
+                                                       request)
+                index = DangerIndex() if request.get('danger') else None
+                observe = index.observe if index else None
+                trace, state = ddonpach.send_rollout(request['actions'],
+                                                     observe=observe)
+        except Exception:
+            if pending and os.path.exists(pending[1]):
+                os.remove(pending[1])
+            raise
+
+        if pending:
+            # Written by now, since the rollout was only read afterwards.
+            self.remember_prefix(*pending, starting_score)
+
+        dangers = index.take() if index else [0] * len(trace)
+        trace = [(s, c, d, False, danger)
+                 for (s, c, d, _), danger in zip(trace, dangers)]
+        if state['scoreScreen'] and trace:
+            score, combo, death, _, danger = trace[-1]
+            trace[-1] = (score, combo, death, True, danger)
+
+        return {'message': 'result', 'score': starting_score,
+                'trace': trace}
+
+    def serve_connection(self, stream):
+        """
+        Answers requests on the given stream until the coordinator hangs up.
+        """
+        while True:
+            try:
+                request, _ = receive(stream)
+            except (OSError, ValueError):
+                return
+
+            if request['command'] == 'hello':
+                send(stream, {'message': 'hello',
+                              'instances': self.instances})
+                continue
+
+            try:
+                reply = self.evaluate(stream, request)
+            except DdonpachSyncError as err:
+                log.error('Desync!')
+                log.exception(err)
+                reply = {'message': 'error', 'error': 'sync'}
+            except (OSError, ValueError) as err:
+                log.error('MAME session crashed!')
+                log.exception(err)
+                reply = {'message': 'error', 'error': 'crash'}
+
+            send(stream, reply)
+
+    def serve(self, host, port):
+        worker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                log.info('Coordinator connected from: %s',
+                         self.client_address)
+                worker.serve_connection(SocketStream(self.request))
+
+        server = socketserver.ThreadingTCPServer((host, port), Handler)
+        server.daemon_threads = True
+        log.info('Worker with %s instances listening on %s:%s',
+                 self.instances, host, port)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self.pool.close()
+
+
+class WorkerConnection:
+    """
+    Connection to one session of a remote worker.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        host, port = address.rsplit(':', 1)
+        self.sock = socket.create_connection((host, int(port)))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stream = SocketStream(self.sock)
+
+    def hello(self):
+        send(self.stream, {'command': 'hello'})
+        message, _ = receive(self.stream)
+        return message['instances']
+
+    def evaluate(self, request, blobs):
+        """
+        Sends the given evaluation request and answers the worker's requests
+        for blobs from the given blob store until the result arrives.
+        """
+        send(self.stream, dict(command='evaluate', **request))
+        while True:
+            message, _ = receive(self.stream)
+            if message['message'] == 'need':
+                key = message['key']
+                data = blobs.get(key)
+                send(self.stream, {'message': 'blob', 'key': key,
+                                   'size': len(data)}, data)
+                continue
+
+            if message['message'] == 'error':
+                if message['error'] == 'sync':
+                    raise DdonpachSyncError('Desync on worker.')
+                raise OSError('Worker session crashed.')
+
+            trace = [(s, c, bool(d), bool(f), danger)
+                     for s, c, d, f, danger in message['trace']]
+            return message['score'], trace
+
+    def close(self):
+        self.sock.close()
+
+
+class BlobStore:
+    """
+    Registry of the savestates and fixed prefixes workers might ask for, keyed
+    by the sha256 of their contents plus an extension telling them apart. Only
+    the `max_blobs` most recently added blobs are kept.
+    """
+
+    def __init__(self, max_blobs=MAX_BLOBS):
+        self.max_blobs = max_blobs
+
+        self.lock = threading.Lock()
+        self.blobs = OrderedDict()
+        self.files = {}
+
+    def add(self, data, ext):
+        key = '{}.{}'.format(content_key(data), ext)
+        with self.lock:
+            self.blobs[key] = data
+            self.blobs.move_to_end(key)
+            while len(self.blobs) > self.max_blobs:
+                self.blobs.popitem(last=False)
+        return key
+
+    def add_file(self, path, ext):
+        """
+        Registers the contents of the file at the given path. Files are only
+        read and hashed again once they changed on disk.
+        """
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            known = self.files.get(path)
+            if known and known[0] == stamp and known[1] in self.blobs:
+                self.blobs.move_to_end(known[1])
+                return known[1]
+
+        with open(path, 'rb') as in_file:
+            key = self.add(in_file.read(), ext)
+        with self.lock:
+            self.files[path] = (stamp, key)
+        return key
+
+    def get(self, key):
+        with self.lock:
+            return self.blobs[key]
+
+
+class Coordinator:
+    """
+    Dispatches evaluations to the workers at the given 'host:port' addresses,
+    holding one connection per worker session. Safe to share between threads;
+    callers block until a session is free. A slot whose connection broke is
+    kept as its address and reconnected the next time it is used.
+    """
+
+    def __init__(self, addresses):
+        self.blobs = BlobStore()
+        self.free = queue.Queue()
+        self.slots = 0
+
+        for address in addresses:
+            first = WorkerConnection(address)
+            instances = first.hello()
+            self.free.put(first)
+            for _ in range(instances - 1):
+                self.free.put(WorkerConnection(address))
+            self.slots += instances
+            log.info('Connected to worker %s with %s instances.', address,
+                     instances)
+
+    def checkout(self):
+        """
+        Returns a free connection, reconnecting it first if it broke.
+        """
+        connection = self.free.get()
+        if isinstance(connection, str):
+            address = connection
+            try:
+                connection = WorkerConnection(address)
+            except OSError:
+                self.free.put(address)
+                raise
+        return connection
+
+    def evaluate(self, state, level, start, fixed, actions, danger=False):
+        """
+        Evaluates the given actions on a worker, starting from the savestate
+        at the given path and the fixed (action, score) pairs of the given
+        level after the first `start` of them. Returns the score at the start
+        of the window and the list of score, combo, death, score screen and
+        danger values after each action. Danger is only measured if `danger`
+        is set and 0 otherwise.
+        """
+        request = {
+            'state': self.blobs.add_file(state, 'sta'),
+            'prefix': self.blobs.add(json.dumps(fixed).encode('utf-8'),
+                                     'json'),
+            'level': level,
+            'start': start,
+            'actions': actions,
+            'danger': danger,
+        }
+
+        connection = self.checkout()
+        try:
+            result = connection.evaluate(request, self.blobs)
+        except (OSError, ValueError):
+            # The slot reconnects when it is next checked out.
+            connection.close()
+            self.free.put(connection.address)
+            raise
+        except DdonpachSyncError:
+            self.free.put(connection)
+            raise
+
+        self.free.put(connection)
+        return result
+
+    def close(self):
+        while not self.free.empty():
+            connection = self.free.get()
+            if not isinstance(connection, str):
+                connection.close()
+
+
+def work(cwd, host, port, instances):
+    worker = Worker(cwd, instances=instances)
+    worker.serve(host, port)
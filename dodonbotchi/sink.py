@@ -0,0 +1,227 @@
+"""
+This module implements sinks for the progress frames rendered during evolution.
+Frames are handed over as PIL images and written out in the background, so the
+evaluation loop never waits for encoding. Frames can either be written as
+numbered PNG files or streamed into an ffmpeg process encoding video segments.
+"""
+import logging as log
+import os
+import queue
+import subprocess
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from PIL import Image
+
+FRAME_WORKERS = 2
+FRAME_BACKLOG = 16
+
+FFMPEG = 'ffmpeg'
+VIDEO_CODEC = 'libx264'
+VIDEO_FPS = 30
+SEGMENT_FRAMES = 9000
+
+
+def write_png(mode, size, data, path):
+    """
+    Encodes the given raw image data as a PNG file at the given path. Runs in
+    a worker process, which is why it takes raw bytes instead of an image.
+    """
+    img = Image.frombytes(mode, size, data)
+    img.save(path)
+
+
+class PngSink:
+    """
+    Writes frames to consecutively numbered PNG files in the given directory
+    using a pool of worker processes, since PNG encoding is CPU-bound. Unless
+    told where to start, numbering continues after the frames already in the
+    directory, so a resumed run does not overwrite them. At most
+    `backlog` frames are encoded at once. While the backlog is full, only the
+    newest frame is held back and older held frames are dropped, so writing
+    never blocks the caller.
+    """
+
+    def __init__(self, out_dir, workers=FRAME_WORKERS, backlog=FRAME_BACKLOG,
+                 start=None):
+        if start is None:
+            numbers = [int(name[:-4]) for name in os.listdir(out_dir)
+                       if name.endswith('.png') and name[:-4].isdigit()]
+            start = max(numbers, default=0) + 1
+
+        self.out_dir = out_dir
+        self.backlog = backlog
+        self.number = start
+
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.lock = threading.RLock()
+        self.pending = set()
+        self.held = None
+
+        self.written = 0
+        self.dropped = 0
+
+    def submit(self, img):
+        path = os.path.join(self.out_dir, '{:09}.png'.format(self.number))
+        self.number += 1
+
+        future = self.executor.submit(write_png, img.mode, img.size,
+                                      img.tobytes(), path)
+        self.pending.add(future)
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+            self.written += 1
+
+            if future.exception():
+                log.error('Failed to write frame: %s', future.exception())
+
+            if self.held and len(self.pending) < self.backlog:
+                held = self.held
+                self.held = None
+                self.submit(held)
+
+    def write(self, img):
+        """
+        Queues the given image to be written as the next frame, holding it
+        back instead if the backlog is full.
+        """
+        with self.lock:
+            if len(self.pending) < self.backlog:
+                self.submit(img)
+                return
+
+            if self.held:
+                self.dropped += 1
+            self.held = img
+
+    def close(self):
+        """
+        Writes any held back frame, waits for every pending frame to be
+        written and shuts the worker processes down.
+        """
+        with self.lock:
+            if self.held:
+                self.submit(self.held)
+                self.held = None
+            pending = list(self.pending)
+
+        wait(pending)
+        self.executor.shutdown(wait=True)
+
+        log.info('Wrote %s frames, dropped %s.', self.written, self.dropped)
+
+
+class VideoSink:
+    """
+    Streams frames as raw RGB data into an ffmpeg subprocess encoding them to
+    numbered video segments in the given directory, starting a new segment
+    every `segment_frames` frames or whenever the frame size changes. Frames
+    are piped from a background thread; if more than `backlog` frames are
+    waiting for it, new frames are dropped instead of blocking the caller.
+    """
+
+    def __init__(self, out_dir, segment_frames=SEGMENT_FRAMES, fps=VIDEO_FPS,
+                 codec=VIDEO_CODEC, ffmpeg=FFMPEG, backlog=FRAME_BACKLOG):
+        self.out_dir = out_dir
+        self.segment_frames = segment_frames
+        self.fps = fps
+        self.codec = codec
+        self.ffmpeg = ffmpeg
+
+        existing = [name for name in os.listdir(out_dir)
+                    if name.endswith('.mp4')]
+        self.segment = len(existing)
+        self.process = None
+        self.size = None
+        self.segment_written = 0
+
+        self.frames = queue.Queue(maxsize=backlog)
+        self.written = 0
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self.pipe_frames)
+        self.thread.start()
+
+    def open_segment(self, size):
+        segment = self.segment + 1
+        path = os.path.join(self.out_dir, '{:06}.mp4'.format(segment))
+        call = [
+            self.ffmpeg, '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+            '-s', '{}x{}'.format(*size), '-r', str(self.fps),
+            '-i', '-',
+            '-c:v', self.codec, '-pix_fmt', 'yuv420p',
+            # yuv420p needs even dimensions
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+            path,
+        ]
+        self.process = subprocess.Popen(call, stdin=subprocess.PIPE)
+        self.segment = segment
+        self.size = size
+        self.segment_written = 0
+        log.info('Writing progress video segment: %s', path)
+
+    def close_segment(self):
+        if not self.process:
+            return
+
+        self.process.stdin.close()
+        ret = self.process.wait()
+        if ret:
+            log.error('ffmpeg exited with code %s on segment %s.', ret,
+                      self.segment)
+        self.process = None
+
+    def pipe_frames(self):
+        while True:
+            img = self.frames.get()
+            if img is None:
+                break
+
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            rotate = self.segment_written >= self.segment_frames
+            if not self.process or rotate or img.size != self.size:
+                self.close_segment()
+                try:
+                    self.open_segment(img.size)
+                except OSError as err:
+                    log.error('Could not start ffmpeg: %s', err)
+                    self.dropped += 1
+                    continue
+
+            try:
+                self.process.stdin.write(img.tobytes())
+                self.segment_written += 1
+                self.written += 1
+            except BrokenPipeError:
+                log.error('Lost ffmpeg process writing segment %s.',
+                          self.segment)
+                self.process = None
+
+        self.close_segment()
+
+    def write(self, img):
+        """
+        Queues the given image to be encoded as the next frame, dropping it if
+        the encoder is too far behind.
+        """
+        try:
+            self.frames.put_nowait(img)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        Encodes every queued frame, finishes the current segment and waits for
+        ffmpeg to exit.
+        """
+        self.frames.put(None)
+        self.thread.join()
+
+        log.info('Wrote %s frames, dropped %s.', self.written, self.dropped)
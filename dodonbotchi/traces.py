@@ -0,0 +1,153 @@
+"""
+This module records the outcome of every evaluated candidate as a trace and
+offers an observer to visualise recorded traces after the fact. Recording is
+cheap enough to stay enabled during headless training runs, which skip all of
+the plotting done in the evaluation loop otherwise.
+
+Traces are stored as one json object per line in a file per level, holding the
+level, the number of fixed steps before the window, the generation, the
+candidate's actions, its per-step score and combo, and its fitness.
+"""
+import json
+import logging as log
+import threading
+
+from pathlib import Path
+
+from dodonbotchi.util import ensure_directories
+
+OBSERVE_EVERY = 10
+
+
+class TraceRecorder:
+    """
+    Appends evaluation traces to per-level files in the given directory. Safe
+    to share between threads.
+    """
+
+    def __init__(self, trc_dir):
+        self.trc_dir = Path(trc_dir)
+        ensure_directories(str(self.trc_dir))
+
+        self.lock = threading.Lock()
+        self.level = None
+        self.out_file = None
+
+    def record(self, level, fixed, generation, actions, trace, fitness):
+        """
+        Records the trace of one evaluated candidate. The trace is a list of
+        (score, combo, death, score screen, danger) tuples, one per step.
+        """
+        record = {
+            'level': level,
+            'fixed': fixed,
+            'generation': generation,
+            'actions': actions,
+            'score': [step[0] for step in trace],
+            'combo': [step[1] for step in trace],
+            'fitness': list(fitness),
+        }
+        line = json.dumps(record)
+
+        with self.lock:
+            if level != self.level:
+                self.close()
+                path = self.trc_dir / '{:03}.jsonl'.format(level)
+                self.out_file = open(path, 'a')
+                self.level = level
+
+            self.out_file.write('{}\n'.format(line))
+
+    def flush(self):
+        with self.lock:
+            if self.out_file:
+                self.out_file.flush()
+
+    def close(self):
+        if self.out_file:
+            self.out_file.close()
+
+        self.out_file = None
+        self.level = None
+
+
+def read_traces(trc_dir):
+    """
+    Yields every trace recorded in the given directory, level by level in the
+    order they were recorded.
+    """
+    for path in sorted(Path(trc_dir).glob('*.jsonl')):
+        with open(path) as in_file:
+            for line in in_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def group_windows(traces):
+    """
+    Groups the given traces by the window they were evaluated in, yielding the
+    level, fixed step count and list of traces of each window.
+    """
+    key = None
+    window = []
+    for trace in traces:
+        trace_key = (trace['level'], trace['fixed'])
+        if trace_key != key and window:
+            yield key[0], key[1], window
+            window = []
+        key = trace_key
+        window.append(trace)
+
+    if window:
+        yield key[0], key[1], window
+
+
+def render_window(level, fixed, window, out_file, every=OBSERVE_EVERY):
+    """
+    Renders a figure summarising the evaluations of one window to the given
+    file: the best fitness reached in each generation and the score and combo
+    curves of every `every`-th evaluation.
+    """
+    from matplotlib import pyplot as plt
+
+    fig, (best_plot, score_plot, combo_plot) = plt.subplots(3, 1,
+                                                           figsize=(8, 8))
+    fig.suptitle('Level {}, {} steps fixed'.format(level, fixed))
+
+    best = {}
+    for trace in window:
+        generation = trace['generation']
+        fitness = trace['fitness'][0]
+        best[generation] = max(best.get(generation, fitness), fitness)
+
+    generations = sorted(best)
+    best_plot.plot(generations, [best[gen] for gen in generations], 'r.-')
+    best_plot.set_ylabel('Best Score')
+
+    for trace in window[::every]:
+        steps = range(len(trace['score']))
+        score_plot.plot(steps, trace['score'], linewidth=0.5)
+        combo_plot.plot(steps, trace['combo'], linewidth=0.5)
+
+    score_plot.set_ylabel('Score')
+    combo_plot.set_ylabel('Combo')
+    combo_plot.set_xlabel('Step')
+
+    fig.savefig(out_file)
+    plt.close(fig)
+
+
+def observe(cwd, every=OBSERVE_EVERY):
+    """
+    Renders a summary figure for every window of recorded traces in the given
+    working directory's trc directory to its obs directory.
+    """
+    cwd = Path(cwd)
+    obs_dir = cwd / 'obs'
+    ensure_directories(str(obs_dir))
+
+    traces = read_traces(cwd / 'trc')
+    for level, fixed, window in group_windows(traces):
+        out_file = obs_dir / '{:03}-{:06}.png'.format(level, fixed)
+        render_window(level, fixed, window, str(out_file), every=every)
+        log.info('Rendered %s traces to: %s', len(window), out_file)
@@ -0,0 +1,173 @@
+"""
+This module implements the compact binary encoding of game states the plugin
+sends when the binary wire format is negotiated. A state consists of a fixed
+header of scalars and object counts, followed by fixed-width records for every
+object of each object class. Records are decoded into NumPy structured arrays,
+one per object class, while the scalars end up in a dictionary shaped like the
+ones produced by the json wire format.
+
+When delta states are negotiated, the plugin only sends what changed since the
+last state it sent, with a full keyframe every so often. Deltas of either wire
+format are applied to the previous full state here to rebuild the current one.
+Objects are identified across states by the slot they occupy in memory.
+
+The layouts defined here have to be kept in sync with `packGameState` and
+`packDelta` in the plugin's `state.lua`.
+"""
+import struct
+
+import numpy as np
+
+WIRE_JSON = 'json'
+WIRE_BINARY = 'binary'
+
+OBJECT_CLASSES = ('enemies', 'bullets', 'ownshot', 'bonuses', 'powerup')
+
+# x_off, frame, death, lives, bombs, score, combo, hit, scoreScreen, ship x,
+# ship y, followed by the object count of each object class
+HEADER = struct.Struct('<hIBBBIBHBhh' + 'H' * len(OBJECT_CLASSES))
+SLOT = struct.Struct('<H')
+
+OBJECT_DTYPE = np.dtype([
+    ('slot', '<u2'),
+    ('id', '<u2'),
+    ('sid', '<u4'),
+    ('pos_x', '<i2'),
+    ('pos_y', '<i2'),
+    ('siz_x', '<u2'),
+    ('siz_y', '<u2'),
+    ('mode', '<u2'),
+])
+
+SHIP_SIZE = 32
+
+
+def decode_header(payload):
+    """
+    Decodes the header of a binary game state or delta and returns the state
+    dictionary holding its scalars, the object counts of each object class and
+    the offset of the first object record.
+    """
+    values = HEADER.unpack_from(payload)
+    x_off, frame, death, lives, bombs, score, combo, hit = values[:8]
+    score_screen, ship_x, ship_y = values[8:11]
+    counts = values[11:]
+
+    ship = {
+        'pos_x': ship_x,
+        'pos_y': ship_y,
+        'siz_x': SHIP_SIZE,
+        'siz_y': SHIP_SIZE,
+    }
+
+    state = {
+        'x_off': x_off,
+        'frame': frame,
+        'ship': [ship],
+        'death': bool(death),
+        'lives': lives,
+        'bombs': bombs,
+        'score': score,
+        'combo': combo,
+        'hit': hit,
+        'scoreScreen': bool(score_screen),
+    }
+
+    return state, counts, HEADER.size
+
+
+def decode_objects(payload, counts, offset):
+    """
+    Decodes consecutive object records of each object class with the given
+    counts starting at the given offset. Returns a dictionary of structured
+    arrays that do not share memory with the payload and the offset after the
+    last record.
+    """
+    objects = {}
+    for name, count in zip(OBJECT_CLASSES, counts):
+        records = np.frombuffer(payload, dtype=OBJECT_DTYPE, count=count,
+                                offset=offset)
+        objects[name] = records.copy()
+        offset += count * OBJECT_DTYPE.itemsize
+
+    return objects, offset
+
+
+def decode_state(payload):
+    """
+    Decodes the given binary game state and returns it as a dictionary with
+    the same keys as the json wire format. Object classes are returned as
+    structured arrays of `OBJECT_DTYPE`.
+    """
+    state, counts, offset = decode_header(payload)
+    objects, offset = decode_objects(payload, counts, offset)
+    state.update(objects)
+
+    if offset != len(payload):
+        raise ValueError('Binary game state has trailing bytes.')
+
+    return state
+
+
+def merge_objects(base, upsert, remove):
+    """
+    Returns the objects of the given base array with every object in a removed
+    slot dropped and every upserted object added or replaced by slot, sorted
+    by slot like the plugin sends them.
+    """
+    stale = np.concatenate((upsert['slot'], remove))
+    kept = base[~np.isin(base['slot'], stale)]
+    merged = np.concatenate((kept, upsert))
+    return merged[np.argsort(merged['slot'], kind='stable')]
+
+
+def decode_delta(payload, base):
+    """
+    Decodes the given binary delta and applies it to the given base state,
+    returning the resulting full state. The base state is not modified.
+    """
+    if base is None:
+        raise ValueError('Received a delta state without a keyframe.')
+
+    state, counts, offset = decode_header(payload)
+    upserts, offset = decode_objects(payload, counts, offset)
+
+    for name in OBJECT_CLASSES:
+        count, = SLOT.unpack_from(payload, offset)
+        offset += SLOT.size
+        remove = np.frombuffer(payload, dtype='<u2', count=count,
+                               offset=offset)
+        offset += count * SLOT.size
+
+        state[name] = merge_objects(base[name], upserts[name], remove)
+
+    if offset != len(payload):
+        raise ValueError('Binary delta state has trailing bytes.')
+
+    return state
+
+
+def apply_delta(base, delta):
+    """
+    Applies the given json delta to the given base state, returning the
+    resulting full state. The base state is not modified.
+    """
+    if base is None:
+        raise ValueError('Received a delta state without a keyframe.')
+
+    state = dict(base)
+    # Empty tables may come out of the plugin's json encoder as empty lists.
+    state.update(delta['scalars'] or {})
+
+    upserts = delta['upsert'] or {}
+    removes = delta['remove'] or {}
+    for name in OBJECT_CLASSES:
+        objects = {obj['slot']: obj for obj in base[name]}
+        for slot in removes.get(name) or []:
+            del objects[slot]
+        for obj in upserts.get(name) or []:
+            objects[obj['slot']] = obj
+
+        state[name] = [objects[slot] for slot in sorted(objects)]
+
+    return state